@@ -0,0 +1,316 @@
+# SCP-079-NOSPAM - Block spam in groups
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-NOSPAM.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark the detection pipeline offline, with synthetic rules, messages and images:
+#
+#     python3 benchmark.py --rules 200 --messages 2000
+#     python3 benchmark.py --data /path/to/data --images /path/to/images
+#
+# The bot's data directory is never touched, the benchmark runs in a temporary working directory
+
+import sys
+from argparse import ArgumentParser, Namespace
+from os import chdir, listdir, mkdir
+from os.path import abspath, dirname, isdir, join
+from random import Random
+from shutil import copy, copytree, rmtree
+from tempfile import mkdtemp
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Tuple
+
+# Words used to generate the rules and the messages
+normal_words = ["hello", "thanks", "group", "today", "meeting", "python", "update", "photo", "weather", "lunch",
+                "你好", "谢谢", "今天", "天气", "会议", "吃饭", "照片", "更新", "學習", "問題"]
+spam_words = ["casino", "bonus", "crypto", "invest", "profit", "airdrop", "escort", "loan", "vpn", "forex",
+              "博彩", "赌场", "兼职", "代理", "贷款", "返利", "色情", "刷单", "投資", "賺錢"]
+
+
+class OfflineClient:
+    # A client without connection, the images are "downloaded" from the corpus, other requests fail
+    def download_media(self, message: str, file_name: str) -> str:
+        return copy(message, file_name)
+
+    def __getattr__(self, name: str) -> Callable:
+        def request(*_, **__):
+            raise ConnectionError(f"Offline benchmark does not support {name}")
+
+        return request
+
+
+def get_args() -> Namespace:
+    # Get the command line arguments
+    parser = ArgumentParser(description="Benchmark the detection pipeline of SCP-079-NOSPAM")
+    parser.add_argument("--rules", type=int, default=100, help="synthetic rules of each word type")
+    parser.add_argument("--messages", type=int, default=1000, help="synthetic messages")
+    parser.add_argument("--spam", type=float, default=0.3, help="ratio of the spam messages")
+    parser.add_argument("--data", default="", help="copy the rule files from a real data directory")
+    parser.add_argument("--images", default="", help="directory of the image corpus")
+    parser.add_argument("--no-images", action="store_true", help="skip the image stages")
+    parser.add_argument("--seed", type=int, default=79, help="random seed")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary working directory")
+
+    return parser.parse_args()
+
+
+def get_config(root: str) -> str:
+    # Get a config that passes the checks, with fake ids and tokens
+    result = []
+    section = ""
+    fake = 0
+
+    with open(join(root, "config.ini.example"), encoding="utf-8") as f:
+        lines = f.read().splitlines()
+
+    for line in lines:
+        if line.startswith("["):
+            section = line
+
+        if "[DATA EXPUNGED]" not in line:
+            result.append(line)
+            continue
+
+        fake += 1
+        key = line.split("=")[0].strip()
+
+        if section == "[bots]" or key == "api_id":
+            value = str(10000 + fake)
+        elif section == "[channels]":
+            value = str(-1001000000000 - fake)
+        else:
+            value = "benchmark"
+
+        result.append(f"{key} = {value}")
+
+    return "\n".join(result) + "\n"
+
+
+def get_images(path: str, corpus: str, random: Random) -> List[str]:
+    # Get the image corpus, generate some images if there is no corpus
+    from PIL import Image, ImageDraw
+
+    if corpus:
+        return [join(corpus, file) for file in sorted(listdir(corpus))
+                if file.lower().endswith((".jpg", ".jpeg", ".png", ".webp"))]
+
+    result = []
+    mkdir(path)
+
+    for i in range(12):
+        file = join(path, f"{i}.png")
+        size = (random.choice([320, 640, 1280]), random.choice([320, 640, 960]))
+
+        if i % 3 == 0:
+            image = Image.new("RGB", size, (230, 200, 40))
+        elif i % 3 == 1:
+            image = Image.effect_noise(size, 64).convert("RGB")
+        else:
+            image = Image.new("RGB", size, (255, 255, 255))
+
+        draw = ImageDraw.Draw(image)
+
+        for line in range(size[1] // 40):
+            words = random.choices(normal_words[:10] + spam_words[:10], k=6)
+            draw.text((10, 10 + line * 40), " ".join(words), fill=(0, 0, 0))
+
+        image.save(file)
+        result.append(file)
+
+    return result
+
+
+def get_messages(count: int, spam: float, samples: Dict[str, List[str]], emojis: List[str], images: List[str],
+                 random: Random) -> List[Any]:
+    # Get synthetic messages
+    from pyrogram.types import Chat, Message, Photo, User
+
+    result = []
+    chat = Chat(id=-1001000000079, type="supergroup", title="Benchmark")
+    bad_types = [t for t in ["ban", "del", "ad", "con", "wb", "wd", "bad"] if samples.get(t)]
+
+    for i in range(count):
+        words = random.choices(normal_words, k=random.randint(3, 30))
+
+        if random.random() < spam and bad_types:
+            words.insert(random.randint(0, len(words)), random.choice(samples[random.choice(bad_types)]))
+
+        if random.random() < 0.1:
+            words += random.choices(emojis, k=random.randint(1, 40))
+
+        user = User(id=100000 + i % 500, is_bot=False, first_name=random.choice(normal_words))
+        text = " ".join(words)
+        photo = None
+
+        if images and random.random() < 0.2:
+            image = random.choice(images)
+            photo = Photo(file_id=image, file_unique_id=f"{i}", width=0, height=0, file_size=0, date=0)
+
+        message = Message(
+            message_id=i + 1,
+            from_user=user,
+            date=1512345678 + i,
+            chat=chat,
+            text=(not photo and text) or None,
+            caption=(photo and text) or None,
+            photo=photo
+        )
+        result.append(message)
+
+    return result
+
+
+def get_rules(count: int, random: Random) -> Tuple[Dict[str, int], List[str]]:
+    # Get synthetic rules of a word type, and the texts that match them
+    rules = {}
+    samples = []
+
+    for _ in range(count):
+        first, second = random.sample(spam_words, 2)
+        number = random.randint(10, 99)
+        kind = random.randint(0, 3)
+
+        if kind == 0:
+            rule, sample = f"{first}{number}", f"{first}{number}"
+        elif kind == 1:
+            rule, sample = f"{first}.{{0,3}}{second}", f"{first} {second}"
+        elif kind == 2:
+            rule, sample = f"(?:{first}|{second})\\d{{2,}}", f"{second}{number}"
+        else:
+            rule, sample = f"\\b{first}\\W*{second}\\b", f"{first}, {second}"
+
+        rules[rule] = 0
+        samples.append(sample)
+
+    return rules, samples
+
+
+def measure(records: Dict[str, List[float]], stage: str, func: Callable, *args) -> Any:
+    # Run a function and record its time
+    start = perf_counter()
+    result = func(*args)
+    records.setdefault(stage, []).append(perf_counter() - start)
+
+    return result
+
+
+def print_report(records: Dict[str, List[float]], get_percentile: Callable) -> None:
+    # Print the throughput and latency of each stage
+    print(f"{'stage':<28}{'count':>8}{'ops/s':>12}{'p50 ms':>10}{'p99 ms':>10}")
+
+    for stage, values in records.items():
+        total = sum(values)
+        throughput = (total and len(values) / total) or 0.0
+        p50 = get_percentile(values, 50) * 1000
+        p99 = get_percentile(values, 99) * 1000
+        print(f"{stage:<28}{len(values):>8}{throughput:>12.1f}{p50:>10.3f}{p99:>10.3f}")
+
+
+def run(args: Namespace) -> None:
+    # Prepare the working directory and run every stage
+    root = dirname(abspath(__file__))
+    path = mkdtemp(prefix="nospam-benchmark-")
+    random = Random(args.seed)
+
+    try:
+        with open(join(path, "config.ini"), "w", encoding="utf-8") as f:
+            f.write(get_config(root))
+
+        if args.data and isdir(args.data):
+            copytree(args.data, join(path, "data"))
+
+        # The global variables are loaded from the working directory when they are imported
+        chdir(path)
+        sys.path.insert(0, root)
+
+        from plugins import glovar
+        from plugins.functions.etc import get_percentile, t2t
+        from plugins.functions.filters import get_regex_hits, is_bad_message, is_emoji, is_regex_text
+        from plugins.functions.ids import init_group_id
+        from plugins.functions.image import start_image_pool
+        from plugins.functions.regex import compile_emoji, compile_words
+        from plugins.functions import worker
+
+        # The offline requests fail at once, they should not wait for the tokens of the real limits
+        for limit in glovar.limits.values():
+            limit["rate"] = limit["burst"] = 1e9
+
+        # Rules
+        samples = {}
+
+        for word_type in glovar.regex:
+            if not args.data:
+                rules, samples[word_type] = get_rules(args.rules, random)
+                setattr(glovar, f"{word_type}_words", rules)
+
+            compile_words(word_type)
+
+        compile_emoji()
+
+        # Images
+        images = []
+
+        if not args.no_images:
+            images = get_images(join(path, "corpus"), args.images, random)
+            start_image_pool()
+
+        # Messages
+        emojis = sorted(glovar.emoji_set)
+        messages = get_messages(args.messages, args.spam, samples, emojis, images, random)
+        client = OfflineClient()
+        records = {}
+
+        for message in messages:
+            init_group_id(message.chat.id)
+
+        # Stages
+        for message in messages:
+            text = message.text or message.caption
+
+            measure(records, "t2t", t2t, text, True, True)
+            measure(records, "emoji", is_emoji, "ad", text)
+            measure(records, "regex all types", lambda: [is_regex_text(t, text) for t in glovar.regex])
+
+            with glovar.locks["hits"]:
+                glovar.hits.clear()
+
+            measure(records, "regex hits", get_regex_hits, text, False, glovar.regex)
+
+        for image in images:
+            measure(records, "image qrcode", worker.get_qrcode, image)
+            measure(records, "image color", worker.get_color, image)
+            measure(records, "image ocr", worker.get_ocr, image)
+
+        # End to end
+        with glovar.locks["image"]:
+            glovar.images.clear()
+
+        for message in messages:
+            start = perf_counter()
+            detection = is_bad_message(client, message)
+            verdict = " ".join(detection.split()[:2]) or "pass"
+            records.setdefault(f"verdict {verdict}", []).append(perf_counter() - start)
+            records.setdefault("verdict all", []).append(perf_counter() - start)
+
+        print_report(records, get_percentile)
+    finally:
+        chdir(root)
+        args.keep and print(f"Working directory: {path}")
+        args.keep or rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    run(get_args())
@@ -25,38 +25,65 @@ from random import randint
 from apscheduler.schedulers.background import BackgroundScheduler
 from pyrogram import Client, idle
 
-from plugins import glovar
-from plugins.functions.etc import delay
-from plugins.functions.timers import backup_files, interval_hour_01, interval_min_10, interval_min_15
-from plugins.functions.timers import reset_data, send_count, update_admins, update_status
-
 # Enable logging
 logger = logging.getLogger(__name__)
 
-# Config session
-app = Client(
-    session_name="bot",
-    bot_token=glovar.bot_token
-)
-app.start()
-
-# Send online status
-delay(3, update_status, [app, "online"])
-
-# Timer
-scheduler = BackgroundScheduler(job_defaults={"misfire_grace_time": 60})
-scheduler.add_job(interval_min_10, "interval", minutes=10)
-scheduler.add_job(interval_min_15, "interval", [app], minutes=15)
-scheduler.add_job(interval_hour_01, "interval", [app], hours=1)
-scheduler.add_job(update_status, "cron", [app, "awake"], minute=randint(30, 34), second=randint(0, 59))
-scheduler.add_job(backup_files, "cron", [app], hour=20)
-scheduler.add_job(send_count, "cron", [app], hour=21)
-scheduler.add_job(reset_data, "cron", [app], day=glovar.date_reset, hour=22)
-scheduler.add_job(update_admins, "cron", [app], hour=22, minute=30)
-scheduler.start()
-
-# Hold
-idle()
-
-# Stop
-app.stop()
+# The image workers run this module as __mp_main__ when they start, only the main process runs the bot
+if __name__ == "__main__":
+    from plugins import glovar
+    from plugins.functions.etc import delay
+    from plugins.functions.file import save_files
+    from plugins.functions.ids import build_expiry, build_trust_groups
+    from plugins.functions.image import start_image_pool
+    from plugins.functions.regex import compile_emoji, compile_words, flush_counts
+    from plugins.functions.timers import backup_files, interval_hour_01, interval_min_10, interval_min_15
+    from plugins.functions.timers import recheck_users, reset_data, send_count, update_admins, update_status
+
+    # Compile regex rules
+    for word_type in glovar.regex:
+        compile_words(word_type)
+
+    compile_emoji()
+
+    # Index the timestamps of the users
+    build_expiry()
+
+    # Index the groups of the trusted users
+    build_trust_groups()
+
+    # Start the image workers
+    start_image_pool()
+
+    # Config session
+    app = Client(
+        session_name="bot",
+        bot_token=glovar.bot_token
+    )
+    app.start()
+
+    # Send online status
+    delay(3, update_status, [app, "online"])
+
+    # Timer
+    scheduler = BackgroundScheduler(job_defaults={"misfire_grace_time": 60})
+    scheduler.add_job(save_files, "interval", seconds=glovar.time_save)
+    scheduler.add_job(interval_min_10, "interval", minutes=10)
+    scheduler.add_job(interval_min_15, "interval", minutes=15)
+    scheduler.add_job(recheck_users, "interval", [app], seconds=glovar.recheck["interval"])
+    scheduler.add_job(interval_hour_01, "interval", [app], hours=1)
+    scheduler.add_job(update_status, "cron", [app, "awake"], minute=randint(30, 34), second=randint(0, 59))
+    scheduler.add_job(backup_files, "cron", [app], hour=20)
+    scheduler.add_job(send_count, "cron", [app], hour=21)
+    scheduler.add_job(reset_data, "cron", [app], day=glovar.date_reset, hour=22)
+    scheduler.add_job(update_admins, "cron", [app], hour=22, minute=30)
+    scheduler.start()
+
+    # Hold
+    idle()
+
+    # Stop
+    app.stop()
+
+    # Save data
+    flush_counts()
+    save_files()
@@ -0,0 +1,124 @@
+# SCP-079-NOSPAM - Block spam in groups
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-NOSPAM.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from time import time
+from typing import Any, Callable
+
+from .. import glovar
+from .etc import thread
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+
+def get_cache(name: str, key: Any, load: Callable[[], Any], cache: bool = True) -> Any:
+    # Get a value from a cache, load it if it is missing or expired, a stale value is refreshed in the background
+    result = None
+
+    try:
+        now = time()
+        refresh = False
+
+        with glovar.locks["cache"]:
+            data = eval(f"glovar.{name}")
+            entry = cache and data.get(key)
+
+            if entry:
+                age = now - entry["time"]
+
+                if age < entry["ttl"] or (entry["value"] and age < glovar.caches[name]["stale"]):
+                    data.move_to_end(key)
+                    result = entry["value"]
+                    refresh = age >= entry["ttl"] and not entry["refreshing"]
+                    entry["refreshing"] = entry["refreshing"] or refresh
+
+                    if not refresh:
+                        return result
+
+        if refresh:
+            thread(load_cache, (name, key, load))
+            return result
+
+        result = load_cache(name, key, load)
+    except Exception as e:
+        logger.warning(f"Get cache {name} error: {e}", exc_info=True)
+
+    return result
+
+
+def load_cache(name: str, key: Any, load: Callable[[], Any]) -> Any:
+    # Load a value and cache it, None means the load failed and nothing is known, so it is not cached
+    result = None
+
+    try:
+        result = load()
+
+        if result is not None:
+            set_cache(name, key, result)
+            return result
+
+        # Let the next lookup try again
+        with glovar.locks["cache"]:
+            entry = eval(f"glovar.{name}").get(key)
+            entry and entry.update(refreshing=False)
+    except Exception as e:
+        logger.warning(f"Load cache {name} error: {e}", exc_info=True)
+
+    return result
+
+
+def remove_cache(name: str, match: Callable[[Any], bool]) -> bool:
+    # Remove the cached values whose keys match
+    try:
+        with glovar.locks["cache"]:
+            data = eval(f"glovar.{name}")
+
+            for key in [key for key in data if match(key)]:
+                data.pop(key, None)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Remove cache {name} error: {e}", exc_info=True)
+
+    return False
+
+
+def set_cache(name: str, key: Any, value: Any) -> bool:
+    # Cache a value, a known missing value is cached for a shorter time, the least recently used values are removed
+    try:
+        config = glovar.caches[name]
+
+        with glovar.locks["cache"]:
+            data = eval(f"glovar.{name}")
+            data[key] = {
+                "value": value,
+                "time": time(),
+                "ttl": (value and config["ttl"]) or config["negative"],
+                "refreshing": False
+            }
+            data.move_to_end(key)
+
+            while len(data) > config["limit"]:
+                data.popitem(last=False)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Set cache {name} error: {e}", exc_info=True)
+
+    return False
@@ -18,15 +18,16 @@
 
 import logging
 from json import dumps
-from typing import List, Optional, Set, Union
+from typing import Dict, List, Optional, Set, Union
 
 from pyrogram import Client
 from pyrogram.types import Chat, Message, User
 
 from .. import glovar
-from .etc import code, code_block, general_link, get_forward_name, get_full_name, get_md5sum, get_text, lang
-from .etc import message_link, thread
+from .etc import code, code_block, general_link, get_context, get_forward_name, get_full_name, get_md5sum, get_now
+from .etc import get_text, lang, message_link, thread
 from .file import crypt_file, data_to_file, delete_file, get_new_path, save
+from .ids import add_window_id
 from .image import get_file_id
 from .telegram import forward_or_copy_message, get_group_info, send_document, send_message
 
@@ -113,7 +114,7 @@ def auto_report(client: Client, message: Message = None, gid: int = 0, uid: int
 def declare_message(client: Client, gid: int, mid: int) -> bool:
     # Declare a message
     try:
-        glovar.declared_message_ids[gid].add(mid)
+        add_window_id("declared_message_ids", gid, mid)
         share_data(
             client=client,
             receivers=glovar.receivers["declare"],
@@ -148,7 +149,7 @@ def exchange_to_hide(client: Client) -> bool:
         text = (f"{lang('project')}{lang('colon')}{code(glovar.sender)}\n"
                 f"{lang('issue')}{lang('colon')}{code(lang('exchange_invalid'))}\n"
                 f"{lang('auto_fix')}{lang('colon')}{code(lang('protocol_1'))}\n")
-        thread(send_message, (client, glovar.critical_channel_id, text))
+        thread(send_message, (client, glovar.critical_channel_id, text), pool="log")
 
         return True
     except Exception as e:
@@ -272,6 +273,11 @@ def get_content(message: Message) -> str:
         if not message:
             return ""
 
+        context = get_context(message)
+
+        if context.get("content") is not None:
+            return context["content"]
+
         file_id, _ = get_file_id(message)
         text = get_text(message)
 
@@ -289,12 +295,41 @@ def get_content(message: Message) -> str:
 
         if text:
             result += get_md5sum("string", text)
+
+        context["content"] = result
     except Exception as e:
         logger.warning(f"Get content error: {e}", exc_info=True)
 
     return result
 
 
+def get_content_cache(content: str) -> str:
+    # Get the cached detection of the content, the expired and the least recently used ones are removed
+    result = ""
+
+    try:
+        if not content:
+            return ""
+
+        with glovar.locks["content"]:
+            cache = glovar.contents.get(content)
+
+            if cache and get_now() - cache["time"] > glovar.time_content:
+                glovar.contents.pop(content, None)
+                cache = None
+
+            if cache:
+                glovar.contents.move_to_end(content)
+                glovar.content_stats["hit"] += 1
+                result = cache["detection"]
+            else:
+                glovar.content_stats["miss"] += 1
+    except Exception as e:
+        logger.warning(f"Get content cache error: {e}", exc_info=True)
+
+    return result
+
+
 def get_debug_text(client: Client, context: Union[int, Chat, List[int]]) -> str:
     # Get a debug message text prefix
     text = ""
@@ -334,7 +369,7 @@ def send_debug(client: Client, chat: Chat, action: str, uid: int, mid: int, em:
         text += (f"{lang('user_id')}{lang('colon')}{code(uid)}\n"
                  f"{lang('action')}{lang('colon')}{code(action)}\n"
                  f"{lang('triggered_by')}{lang('colon')}{general_link(mid, message_link(em))}\n")
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="log")
 
         return True
     except Exception as e:
@@ -343,6 +378,31 @@ def send_debug(client: Client, chat: Chat, action: str, uid: int, mid: int, em:
     return False
 
 
+def set_content_cache(content: str, detection: str = "") -> bool:
+    # Cache the detection of the content, remove the cache if the detection is empty
+    try:
+        if not content:
+            return False
+
+        with glovar.locks["content"]:
+            if detection:
+                glovar.contents[content] = {"detection": detection, "time": get_now()}
+                glovar.contents.move_to_end(content)
+            elif glovar.contents.pop(content, None) is None:
+                return True
+
+            while len(glovar.contents) > glovar.limit_content:
+                glovar.contents.popitem(last=False)
+
+        save("contents")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Set content cache error: {e}", exc_info=True)
+
+    return False
+
+
 def share_bad_user(client: Client, uid: int) -> bool:
     # Share a bad user with other bots
     try:
@@ -370,7 +430,8 @@ def share_data(client: Client, receivers: List[str], action: str, action_type: s
     try:
         thread(
             target=share_data_thread,
-            args=(client, receivers, action, action_type, data, file, encrypt)
+            args=(client, receivers, action, action_type, data, file, encrypt),
+            pool="exchange"
         )
 
         return True
@@ -417,7 +478,7 @@ def share_data_thread(client: Client, receivers: List[str], action: str, action_
             # Delete the tmp file
             if result:
                 for f in {file, file_path}:
-                    f.startswith("tmp/") and thread(delete_file, (f,))
+                    f.startswith("tmp/") and thread(delete_file, (f,), pool="file")
         else:
             text = format_data(
                 sender=glovar.sender,
@@ -432,7 +493,7 @@ def share_data_thread(client: Client, receivers: List[str], action: str, action_
         if result is False and not glovar.should_hide:
             # Use hide channel instead
             exchange_to_hide(client)
-            thread(share_data, (client, receivers, action, action_type, data, file, encrypt))
+            thread(share_data, (client, receivers, action, action_type, data, file, encrypt), pool="exchange")
 
         return True
     except Exception as e:
@@ -441,16 +502,19 @@ def share_data_thread(client: Client, receivers: List[str], action: str, action_
     return False
 
 
-def share_regex_count(client: Client, word_type: str) -> bool:
+def share_regex_count(client: Client, word_type: str, counts: Dict[str, int]) -> bool:
     # Use this function to share regex count to REGEX
     try:
         if not glovar.regex.get(word_type):
             return True
 
-        if not eval(f"glovar.{word_type}_words"):
+        rules = eval(f"glovar.{word_type}_words")
+
+        if not rules:
             return True
 
-        file = data_to_file(eval(f"glovar.{word_type}_words"))
+        words = {word: counts.get(word, 0) for word in rules}
+        file = data_to_file(words)
         share_data(
             client=client,
             receivers=["REGEX"],
@@ -474,7 +538,7 @@ def update_score(client: Client, uid: int) -> bool:
         bad_count = sum(glovar.user_ids[uid]["bad"][gid] for gid in list(glovar.user_ids[uid]["bad"]))
         score = delete_count * 0.6 + bad_count * 0.1
         glovar.user_ids[uid]["score"][glovar.sender.lower()] = score
-        save("user_ids")
+        save("user_ids", uid)
         share_data(
             client=client,
             receivers=glovar.receivers["score"],
@@ -46,11 +46,11 @@ def retry(func):
     return wrapper
 
 
-def threaded(daemon: bool = True):
+def threaded(daemon: bool = True, pool: str = "io"):
     # Run with thread
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            return thread(func, args, kwargs, daemon)
+            return thread(func, args, kwargs, daemon, pool)
         return wrapper
     return decorator
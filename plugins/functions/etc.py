@@ -18,16 +18,19 @@
 
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from hashlib import md5
+from heapq import heappop, heappush
 from html import escape
 from json import dumps
 from random import choice, uniform
 from re import sub
 from string import ascii_letters, digits
-from threading import Thread, Timer
+from threading import Lock, Thread
 from time import localtime, sleep, strftime, time
-from typing import Any, Callable, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, Iterator, List, Optional, Union
 from unicodedata import normalize
 
 from cryptography.fernet import Fernet
@@ -44,6 +47,13 @@ logger = logging.getLogger(__name__)
 converter = OpenCC(config="t2s.json")
 
 
+class TokenWait(BaseException):
+    # Raised in a task of a requeue pool that should wait for the tokens, it is not an error of the task
+    def __init__(self, secs: float):
+        super().__init__(secs)
+        self.secs = secs
+
+
 def bold(text: Any) -> str:
     # Get a bold text
     try:
@@ -118,12 +128,16 @@ def crypt_str(operation: str, text: str, key: bytes) -> str:
     return result
 
 
-def delay(secs: int, target: Callable, args: list) -> bool:
-    # Call a function with delay
+def delay(secs: float, target: Callable, args: list, pool: str = "io", kwargs: dict = None) -> bool:
+    # Call a function with delay, the function runs in the pool, all the delays share one timer thread
     try:
-        t = Timer(secs, target, args)
-        t.daemon = True
-        t.start()
+        with glovar.locks["delay"]:
+            if glovar.delay_thread is None:
+                glovar.delay_thread = Thread(target=run_delays, name="delay", daemon=True)
+                glovar.delay_thread.start()
+
+            heappush(glovar.delays, (time() + secs, next(glovar.delay_ids), target, tuple(args), kwargs, pool))
+            glovar.locks["delay"].notify()
 
         return True
     except Exception as e:
@@ -147,6 +161,30 @@ def general_link(text: Union[int, str], link: str) -> str:
     return result
 
 
+def get_bucket(kind: str, cid: int, now: float) -> Dict[str, float]:
+    # Get a refilled token bucket, should be called with the limit lock
+    result = {}
+
+    try:
+        limit = glovar.limits[kind]
+        result = glovar.buckets.get((kind, cid))
+
+        if result is None:
+            result = {"tokens": limit["burst"], "rate": limit["rate"], "time": now, "until": 0.0}
+            glovar.buckets[(kind, cid)] = result
+            return result
+
+        # The rate lowered by floods recovers in 10 minutes
+        elapsed = max(now - result["time"], 0.0)
+        result["rate"] = min(limit["rate"], result["rate"] + limit["rate"] * elapsed / 600)
+        result["tokens"] = min(limit["burst"], result["tokens"] + result["rate"] * elapsed)
+        result["time"] = now
+    except Exception as e:
+        logger.warning(f"Get bucket error: {e}", exc_info=True)
+
+    return result
+
+
 def get_channel_link(message: Union[int, Message]) -> str:
     # Get a channel reference link
     text = ""
@@ -205,6 +243,21 @@ def get_command_type(message: Message) -> str:
     return result
 
 
+def get_context(obj: Any) -> Dict[Any, Any]:
+    # Get the analysis context of a message or a user, the values in it are computed only once for the object
+    result = {}
+
+    try:
+        if obj is None:
+            return {}
+
+        result = obj.__dict__.setdefault("_context", {})
+    except Exception as e:
+        logger.warning(f"Get context error: {e}", exc_info=True)
+
+    return result
+
+
 def get_entity_text(message: Message, entity: MessageEntity) -> str:
     # Get a message's entity text
     result = ""
@@ -224,6 +277,22 @@ def get_entity_text(message: Message, entity: MessageEntity) -> str:
     return result
 
 
+def get_executor(pool: str) -> Optional[ThreadPoolExecutor]:
+    # Get the executor of a named thread pool, should be called with the pool lock
+    result = None
+
+    try:
+        result = glovar.executors.get(pool)
+
+        if result is None:
+            result = ThreadPoolExecutor(glovar.pools[pool]["workers"], thread_name_prefix=pool)
+            glovar.executors[pool] = result
+    except Exception as e:
+        logger.warning(f"Get executor error: {e}", exc_info=True)
+
+    return result
+
+
 def get_filename(message: Message, normal: bool = False, printable: bool = False) -> str:
     # Get file's filename
     text = ""
@@ -300,6 +369,11 @@ def get_links(message: Message) -> List[str]:
     # Get a message's links
     result = []
     try:
+        context = get_context(message)
+
+        if context.get("links") is not None:
+            return list(context["links"])
+
         entities = message.entities or message.caption_entities
 
         if entities:
@@ -337,6 +411,8 @@ def get_links(message: Message) -> List[str]:
                         continue
 
                     result.append(url)
+
+        context["links"] = list(result)
     except Exception as e:
         logger.warning(f"Get links error: {e}", exc_info=True)
 
@@ -377,6 +453,22 @@ def get_now() -> int:
     return result
 
 
+def get_percentile(values: List[float], percent: int) -> float:
+    # Get the percentile of some values
+    result = 0.0
+
+    try:
+        if not values:
+            return 0.0
+
+        values = sorted(values)
+        result = values[min(len(values) - 1, len(values) * percent // 100)]
+    except Exception as e:
+        logger.warning(f"Get percentile error: {e}", exc_info=True)
+
+    return result
+
+
 def get_readable_time(secs: int = 0, the_format: str = "%Y%m%d%H%M%S") -> str:
     # Get a readable time string
     result = ""
@@ -492,6 +584,12 @@ def get_text(message: Message, normal: bool = False, printable: bool = False) ->
         if not message or (not message.text and not message.caption):
             return ""
 
+        context = get_context(message)
+        key = ("text", normal, printable)
+
+        if context.get(key) is not None:
+            return context[key]
+
         the_text = message.text or message.caption
 
         if the_text:
@@ -523,12 +621,26 @@ def get_text(message: Message, normal: bool = False, printable: bool = False) ->
 
         if text:
             text = t2t(text, normal, printable)
+
+        context[key] = text
     except Exception as e:
         logger.warning(f"Get text error: {e}", exc_info=True)
 
     return text
 
 
+def get_user_lock(uid: int) -> Lock:
+    # Get the striped lock of a user, the messages of the same user are checked in order
+    result = glovar.user_locks[0]
+
+    try:
+        result = glovar.user_locks[uid % len(glovar.user_locks)]
+    except Exception as e:
+        logger.warning(f"Get user lock error: {e}", exc_info=True)
+
+    return result
+
+
 def italic(text: Any) -> str:
     # Get italic text
     try:
@@ -553,6 +665,19 @@ def lang(text: str) -> str:
     return result
 
 
+@contextmanager
+def lock_users() -> Iterator[None]:
+    # Hold all the striped user locks, stop the message checks while the user data is changed as a whole
+    for lock in glovar.user_locks:
+        lock.acquire()
+
+    try:
+        yield
+    finally:
+        for lock in reversed(glovar.user_locks):
+            lock.release()
+
+
 def mention_id(uid: int) -> str:
     # Get a ID mention string
     result = ""
@@ -587,19 +712,113 @@ def random_str(i: int) -> str:
     return text
 
 
+def run_delays() -> None:
+    # Submit the delayed functions to their pools when they are due, the target of the timer thread
+    while True:
+        try:
+            with glovar.locks["delay"]:
+                while not glovar.delays or glovar.delays[0][0] > time():
+                    glovar.locks["delay"].wait(glovar.delays[0][0] - time() if glovar.delays else None)
+
+                _, _, target, args, kwargs, pool = heappop(glovar.delays)
+
+            thread(target, args, kwargs, pool=pool)
+        except Exception as e:
+            logger.warning(f"Run delays error: {e}", exc_info=True)
+
+
+def run_task(pool: str, target: Callable, args: tuple, kwargs: Optional[dict]) -> Any:
+    # Run a task of a thread pool, a task of a requeue pool waiting for the tokens is queued again
+    result = None
+    secs = 0.0
+    tasks = glovar.tasks
+    state = (getattr(tasks, "pool", ""), getattr(tasks, "requested", False))
+
+    try:
+        tasks.pool = pool
+        tasks.requested = False
+        result = target(*args, **(kwargs or {}))
+    except TokenWait as e:
+        secs = e.secs
+    except Exception as e:
+        logger.warning(f"Run task {getattr(target, '__name__', target)} error: {e}", exc_info=True)
+    finally:
+        tasks.pool, tasks.requested = state
+
+        with glovar.locks["pool"]:
+            glovar.pools[pool]["pending"] -= 1
+
+    # The worker is released before the tokens are available
+    secs and delay(secs, target, list(args), pool, kwargs)
+
+    return result
+
+
+def set_flood(kind: str, cid: int, secs: float) -> bool:
+    # Learn from a FloodWait, stop the bucket for the time and halve its rate
+    try:
+        if cid and kind in {"log", "send"}:
+            kind = "chat"
+        else:
+            cid = 0
+
+        with glovar.locks["limit"]:
+            bucket = get_bucket(kind, cid, time())
+            bucket["until"] = max(bucket["until"], time() + secs + uniform(0.5, 1.0))
+            bucket["rate"] = max(bucket["rate"] / 2, glovar.limits[kind]["rate"] / 20)
+            bucket["tokens"] = min(bucket["tokens"], 0.0)
+            glovar.limits[kind]["floods"] += 1
+
+        logger.warning(f"FloodWait {secs} second(s) for {kind} {cid or ''}")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Set flood error: {e}", exc_info=True)
+
+    return False
+
+
+def set_t2t_table() -> Dict[int, str]:
+    # Generate the translate table of the special characters, clear the converted texts
+    result = {}
+
+    try:
+        for key in set(glovar.spc_dict) | set(glovar.spe_dict):
+            value = glovar.spc_dict.get(key, key)
+            value = glovar.spe_dict.get(value, value)
+            result[ord(key)] = value
+
+        with glovar.locks["t2t"]:
+            glovar.t2t_table = result
+            glovar.t2t_texts.clear()
+    except Exception as e:
+        logger.warning(f"Set t2t table error: {e}", exc_info=True)
+
+    return result
+
+
 def t2t(text: str, normal: bool, printable: bool, pure: bool = False) -> str:
     # Convert the string, text to text
     try:
         if not text:
             return ""
 
-        if normal:
-            for special in ["spc", "spe"]:
-                text = "".join(eval(f"glovar.{special}_dict").get(t, t) for t in text)
+        key = (text, normal, printable, pure)
+
+        with glovar.locks["t2t"]:
+            result = glovar.t2t_texts.get(key)
 
+            if result is not None:
+                glovar.t2t_texts.move_to_end(key)
+                return result
+
+        table = glovar.t2t_table
+
+        if normal:
+            text = text.translate(table if table is not None else set_t2t_table())
             text = normalize("NFKC", text)
 
-        if printable:
+        if printable and not text.isprintable():
             text = "".join(t for t in text if t.isprintable() or t in {"\n", "\r", "\t"})
 
         if normal and glovar.zh_cn:
@@ -607,29 +826,62 @@ def t2t(text: str, normal: bool, printable: bool, pure: bool = False) -> str:
 
         if pure:
             text = sub(r"""[^\da-zA-Z一-龥.,:'"?!~;()。，？！～@“”]""", "", text)
+
+        with glovar.locks["t2t"]:
+            # The table has been changed during the conversion
+            if table is not glovar.t2t_table:
+                return text
+
+            glovar.t2t_texts[key] = text
+
+            while len(glovar.t2t_texts) > glovar.limit_text:
+                glovar.t2t_texts.popitem(last=False)
     except Exception as e:
         logger.warning(f"T2T error: {e}", exc_info=True)
 
     return text
 
 
-def thread(target: Callable, args: tuple, kwargs: dict = None, daemon: bool = True) -> bool:
-    # Call a function using thread
+def thread(target: Callable, args: tuple, kwargs: dict = None, daemon: bool = True, pool: str = "io") -> bool:
+    # Call a function in a bounded thread pool, the caller runs it if the pool's queue is full
     result = False
 
     try:
-        t = Thread(target=target, args=args, kwargs=kwargs, daemon=daemon)
-        t.daemon = daemon
-        result = t.start() or True
+        # The interpreter does not wait for daemon threads only
+        if not daemon:
+            t = Thread(target=target, args=args, kwargs=kwargs, daemon=daemon)
+            return t.start() or True
+
+        with glovar.locks["pool"]:
+            stats = glovar.pools[pool]
+            full = stats["pending"] >= stats["queue"]
+
+            stats["pending"] += 1
+
+            if full:
+                stats["overflow"] += 1
+            else:
+                stats["peak"] = max(stats["peak"], stats["pending"])
+                executor = get_executor(pool)
+
+        if full:
+            run_task(pool, target, args, kwargs)
+            return True
+
+        executor.submit(run_task, pool, target, args, kwargs)
+        result = True
     except Exception as e:
         logger.warning(f"Thread error: {e}", exc_info=True)
 
     return result
 
 
-def wait_flood(e: FloodWait) -> bool:
-    # Wait flood secs
+def wait_flood(e: FloodWait, kind: str = "", cid: int = 0) -> bool:
+    # Wait flood secs, the wait of a kind of requests is left to the token bucket shared by them
     try:
+        if kind:
+            return set_flood(kind, cid, e.x)
+
         sleep(e.x + uniform(0.5, 1.0))
 
         return True
@@ -637,3 +889,60 @@ def wait_flood(e: FloodWait) -> bool:
         logger.warning(f"Wait flood error: {e}", exc_info=True)
 
     return False
+
+
+def wait_token(kind: str, cid: int = 0) -> bool:
+    # Wait for the tokens of an outbound request, raise TokenWait instead in the first request of a requeue pool's task
+    result = False
+
+    try:
+        # The sends to the logging channels have the lowest priority
+        if kind == "send" and cid in {glovar.critical_channel_id, glovar.debug_channel_id, glovar.logging_channel_id}:
+            kind = "log"
+
+        # Requeue the task only if it has not made any request, so the requests will not be repeated
+        tasks = glovar.tasks
+        pool = getattr(tasks, "pool", "")
+        requeue = pool and glovar.pools[pool]["requeue"] and not getattr(tasks, "requested", False)
+
+        keys = [("all", 0), (kind, 0)]
+
+        if cid and kind in {"log", "send"}:
+            keys.append(("chat", cid))
+
+        with glovar.locks["limit"]:
+            glovar.limits[kind]["waiting"] += 1
+
+        try:
+            while not result:
+                with glovar.locks["limit"]:
+                    now = time()
+                    wait = 0.0
+
+                    for key in keys:
+                        bucket = get_bucket(key[0], key[1], now)
+                        need = 1 + (glovar.limits[kind]["reserve"] if key[0] == "all" else 0)
+
+                        if now < bucket["until"]:
+                            wait = max(wait, bucket["until"] - now)
+                        elif bucket["tokens"] < need:
+                            wait = max(wait, (need - bucket["tokens"]) / bucket["rate"])
+
+                    if not wait:
+                        for key in keys:
+                            glovar.buckets[key]["tokens"] -= 1
+
+                        result = True
+                    elif requeue:
+                        raise TokenWait(wait)
+
+                wait and sleep(min(wait, 1.0))
+
+            tasks.requested = True
+        finally:
+            with glovar.locks["limit"]:
+                glovar.limits[kind]["waiting"] -= 1
+    except Exception as e:
+        logger.warning(f"Wait token error: {e}", exc_info=True)
+
+    return result
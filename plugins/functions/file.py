@@ -17,17 +17,17 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from os import remove
+from os import remove, replace
 from os.path import exists
-from pickle import dump
-from shutil import copyfile
-from typing import Any
+from pickle import dump, dumps
+from time import time
+from typing import Any, Dict
 
 from pyAesCrypt import decryptFile, encryptFile
 from pyrogram import Client
 
 from .. import glovar
-from .etc import random_str, thread
+from .etc import random_str
 from .telegram import download_media
 
 # Enable logging
@@ -113,10 +113,14 @@ def get_new_path(extension: str = "", prefix: str = "") -> str:
     return result
 
 
-def save(file: str) -> bool:
-    # Save a global variable to a file
+def save(file: str, key: Any = None) -> bool:
+    # Mark a global variable to be saved to a file by the writer, only the key will be journaled if possible
     try:
-        thread(save_thread, (file,), None, False)
+        with glovar.locks["save"]:
+            if key is None or file not in glovar.journal_list:
+                glovar.saves.setdefault(file, time())
+            else:
+                glovar.journals.setdefault(file, {}).setdefault(key, time())
 
         return True
     except Exception as e:
@@ -125,19 +129,105 @@ def save(file: str) -> bool:
     return False
 
 
-def save_thread(file: str) -> bool:
-    # Save thread
+def save_file(file: str) -> bool:
+    # Save a global variable to a file
     try:
         if not glovar:
             return True
 
+        data = dumps(eval(f"glovar.{file}"))
+
         with open(f"data/.{file}", "wb") as f:
-            dump(eval(f"glovar.{file}"), f)
+            f.write(data)
+
+        with open(f"data/{file}.tmp", "wb") as f:
+            f.write(data)
+
+        replace(f"data/{file}.tmp", f"data/{file}")
+
+        # The snapshot contains all the journaled records
+        if file in glovar.journal_list:
+            with open(f"data/{file}.journal", "wb"):
+                pass
+
+            glovar.journal_sizes[file] = 0
+
+        return True
+    except Exception as e:
+        logger.error(f"Save file error: {e}", exc_info=True)
+
+    return False
+
+
+def save_files(compact: bool = False) -> bool:
+    # Save all marked global variables, only one writer at the same time
+    glovar.locks["file"].acquire()
+    try:
+        with glovar.locks["save"]:
+            saves = glovar.saves
+            glovar.saves = {}
+            journals = glovar.journals
+            glovar.journals = {}
+
+        # Compact the journals into snapshots
+        for file in glovar.journal_list:
+            keys = journals.get(file, {})
+            size = glovar.journal_sizes.get(file, 0) + len(keys)
+
+            if not size or (not compact and size <= glovar.limit_journal):
+                continue
+
+            saves.setdefault(file, min(keys.values(), default=time()))
+
+        for file in saves:
+            if save_file(file):
+                glovar.save_delays.append(time() - saves[file])
+                continue
+
+            # Try again next time
+            with glovar.locks["save"]:
+                glovar.saves.setdefault(file, saves[file])
+
+        for file in journals:
+            if file in saves:
+                continue
+
+            keys = journals[file]
+
+            if save_journal(file, keys):
+                glovar.save_delays.append(time() - min(keys.values()))
+                continue
+
+            # Try again next time
+            with glovar.locks["save"]:
+                for key in keys:
+                    glovar.journals.setdefault(file, {}).setdefault(key, keys[key])
+
+        return True
+    except Exception as e:
+        logger.warning(f"Save files error: {e}", exc_info=True)
+    finally:
+        glovar.locks["file"].release()
+
+    return False
+
+
+def save_journal(file: str, keys: Dict[Any, float]) -> bool:
+    # Append the latest records of the keys to the file's journal, None means the key has been removed
+    try:
+        if not glovar or not keys:
+            return True
+
+        data = eval(f"glovar.{file}")
+        records = b"".join(dumps((key, data.get(key))) for key in keys)
+
+        with open(f"data/{file}.journal", "ab") as f:
+            f.write(records)
 
-        copyfile(f"data/.{file}", f"data/{file}")
+        glovar.journal_sizes[file] = glovar.journal_sizes.get(file, 0) + len(keys)
 
         return True
     except Exception as e:
-        logger.error(f"Save thread error: {e}", exc_info=True)
+        logger.error(f"Save journal error: {e}", exc_info=True)
 
     return False
@@ -18,21 +18,21 @@
 
 import logging
 import re
-from copy import deepcopy
 from string import ascii_lowercase
-from typing import Match, Optional, Union
+from typing import Dict, Iterable, Match, Optional, Tuple, Union
 
 from pyrogram import Client, filters
 from pyrogram.types import CallbackQuery, Message, User
 
 from .. import glovar
-from .channel import get_content
-from .etc import get_channel_link, get_filename, get_entity_text, get_forward_name, get_full_name, get_md5sum, get_now
+from .channel import get_content, get_content_cache
+from .etc import get_channel_link, get_filename, get_entity_text, get_forward_name, get_full_name, get_now
 from .etc import get_links, get_stripped_link, get_text, t2t, thread
-from .file import delete_file, get_downloaded_path, save
+from .file import delete_file
 from .group import get_description, get_group_sticker, get_member, get_pinned
-from .ids import init_group_id
-from .image import get_color, get_file_id, get_ocr, get_qrcode
+from .ids import init_group_id, is_window_id
+from .image import get_image, get_image_value, get_path_image
+from .regex import count_word, get_contacts_found, get_emoji_dict, get_regex_match
 from .telegram import get_chat, get_sticker_title, resolve_username
 
 # Enable logging
@@ -302,6 +302,66 @@ test_group = filters.create(
 )
 
 
+def get_regex_hits(text: str, ocr: bool = False, word_types: Iterable[str] = ()) -> Dict[str, Optional[Match]]:
+    # Get the text's regex hits of the types, check the types that have not been checked yet, count every hit
+    result = {}
+
+    try:
+        if not text:
+            return {}
+
+        key = (text, ocr)
+
+        with glovar.locks["hits"]:
+            hits = glovar.hits.get(key)
+
+            if hits is None:
+                hits = {}
+                glovar.hits[key] = hits
+
+            while len(glovar.hits) > glovar.limit_hits:
+                glovar.hits.pop(next(iter(glovar.hits)))
+
+        for word_type in word_types:
+            if word_type not in hits:
+                hits[word_type] = get_regex_text(word_type, text, ocr)
+
+            word, result[word_type] = hits[word_type]
+
+            # A cached hit is still a hit of the rule
+            result[word_type] and count_word(word_type, word)
+    except Exception as e:
+        logger.warning(f"Get regex hits error: {e}", exc_info=True)
+
+    return result
+
+
+def get_regex_text(word_type: str, text: str, ocr: bool = False, again: bool = False) -> Tuple[str, Optional[Match]]:
+    # Get the matched rule of the text and its match object, without counting
+    try:
+        if text:
+            if not again:
+                text = re.sub(r"\s{2,}", " ", text)
+            elif " " in text:
+                text = re.sub(r"\s", "", text)
+            else:
+                return "", None
+        else:
+            return "", None
+
+        word, result = get_regex_match(word_type, text, ocr)
+
+        if result:
+            return word, result
+
+        # Try again
+        return get_regex_text(word_type, text, ocr, True)
+    except Exception as e:
+        logger.warning(f"Get regex text error: {e}", exc_info=True)
+
+    return "", None
+
+
 def is_ad_text(text: str, ocr: bool, matched: str = "") -> str:
     # Check if the text is ad text
     try:
@@ -309,7 +369,7 @@ def is_ad_text(text: str, ocr: bool, matched: str = "") -> str:
             return ""
 
         for c in ascii_lowercase:
-            if c != matched and is_regex_text(f"ad{c}", text, ocr):
+            if c != matched and is_regex_hit(f"ad{c}", text, ocr):
                 return c
     except Exception as e:
         logger.warning(f"Is ad text error: {e}", exc_info=True)
@@ -320,18 +380,20 @@ def is_ad_text(text: str, ocr: bool, matched: str = "") -> str:
 def is_avatar_image(path: str) -> bool:
     # Check if the image is avatar image
     try:
+        image = get_path_image(path)
+
         # Check QR code
-        qrcode = get_qrcode(path)
+        qrcode = get_image_value(None, image, "qrcode")
 
         if qrcode:
-            if is_regex_text("ava", qrcode) or is_ban_text(qrcode, False):
+            if is_regex_hit("ava", qrcode) or is_ban_text(qrcode, False):
                 return True
 
         # Check OCR
-        ocr = get_ocr(path)
+        ocr = get_image_value(None, image, "ocr")
 
         if ocr:
-            if is_regex_text("ava", ocr, True) or is_ban_text(ocr, True):
+            if is_regex_hit("ava", ocr, True) or is_ban_text(ocr, True):
                 return True
     except Exception as e:
         logger.warning(f"Is avatar image error: {e}", exc_info=True)
@@ -365,6 +427,8 @@ def is_sender_chat(message: Message) -> bool:
 
 def is_bad_message(client: Client, message: Message, text: str = None, image_path: str = None) -> str:
     # Check if the message is bad message
+    image = {}
+
     if image_path:
         need_delete = [image_path]
     else:
@@ -403,7 +467,7 @@ def is_bad_message(client: Client, message: Message, text: str = None, image_pat
                 if is_contact(name):
                     return "ban nick contact"
 
-                if is_regex_text("wb", name) and is_regex_text("sho", name):
+                if is_regex_hit("wb", name) and is_regex_hit("sho", name):
                     return "ban nick"
 
             # Check the username
@@ -424,7 +488,7 @@ def is_bad_message(client: Client, message: Message, text: str = None, image_pat
             limited_user = is_limited_user(gid, message.from_user, now, glovar.configs[gid].get("new"))
 
             if message_content:
-                detection = glovar.contents.get(message_content, "")
+                detection = get_content_cache(message_content)
 
                 if detection.startswith("ban message"):
                     return "ban message"
@@ -470,12 +534,12 @@ def is_bad_message(client: Client, message: Message, text: str = None, image_pat
                 if is_nm_text(forward_name):
                     return "ban from"
 
-                if message.forward_from_chat and is_regex_text("fcnm", forward_name):
+                if message.forward_from_chat and is_regex_hit("fcnm", forward_name):
                     return "ban from"
 
                 if (message.forward_from_chat
                         and message.forward_from_chat.username
-                        and is_regex_text("fcnm", message.forward_from_chat.username)):
+                        and is_regex_hit("fcnm", message.forward_from_chat.username)):
                     return f"ban from {message.forward_from_chat.username}"
 
                 if is_contact(forward_name):
@@ -530,13 +594,13 @@ def is_bad_message(client: Client, message: Message, text: str = None, image_pat
             file_name = get_filename(message, True, True)
 
             if file_name:
-                if is_regex_text("fil", file_name) or is_ban_text(file_name, False):
+                if is_regex_hit("fil", file_name) or is_ban_text(file_name, False):
                     return "ban message"
 
             # Check the caption
             caption = message.caption
 
-            if caption and is_regex_text("cap", caption):
+            if caption and is_regex_hit("cap", caption):
                 return "ban message"
 
             # Check image
@@ -545,36 +609,34 @@ def is_bad_message(client: Client, message: Message, text: str = None, image_pat
             all_text = ""
 
             # Get the image
-            file_id, big = get_file_id(message)
-            image_path = big and get_downloaded_path(client, file_id)
-            image_path and need_delete.append(image_path)
+            image = get_image(client, message, False)
 
             # Check declared status
             if is_declared_message(None, None, message):
                 return ""
 
             # Check hash
-            image_hash = image_path and get_md5sum("file", image_path)
+            image_hash = image["hash"]
 
-            if image_path and image_hash and image_hash not in glovar.except_ids["temp"]:
+            if image_hash and image_hash not in glovar.except_ids["temp"]:
                 # Check declare status
                 if is_declared_message(None, None, message):
                     return ""
 
-                if big:
+                if image["big"]:
                     # Get QR code
-                    qrcode = get_qrcode(image_path)
+                    qrcode = get_image_value(client, image, "qrcode")
 
                     if qrcode:
                         if is_ban_text(qrcode, False):
                             return "ban message"
 
-                        if is_regex_text("ad", message_text) or is_ad_text(message_text, False):
+                        if is_regex_hit("ad", message_text) or is_ad_text(message_text, False):
                             return "ban message"
 
                     # Get OCR
                     if glovar.configs[gid].get("ocr"):
-                        ocr = get_ocr(image_path)
+                        ocr = get_image_value(client, image, "ocr")
 
                         if ocr:
                             message.new_chat_title = ocr
@@ -644,25 +706,25 @@ def is_bad_message(client: Client, message: Message, text: str = None, image_pat
 
             # Check the message's text
             if message_text:
-                if is_regex_text("del", message_text):
+                if is_regex_hit("del", message_text):
                     return "del message"
 
             # Check the document filename:
             if file_name:
-                if is_regex_text("del", file_name):
+                if is_regex_hit("del", file_name):
                     return "del message"
 
             # Check image
             if qrcode:
-                if is_regex_text("del", qrcode):
+                if is_regex_hit("del", qrcode):
                     return "del message"
 
             if ocr:
-                if is_regex_text("del", ocr, True):
+                if is_regex_hit("del", ocr, True):
                     return "del ocr"
 
             if all_text:
-                if is_regex_text("del", all_text, True):
+                if is_regex_hit("del", all_text, True):
                     return "del ocr"
 
                 if is_contact(all_text):
@@ -682,11 +744,11 @@ def is_bad_message(client: Client, message: Message, text: str = None, image_pat
 
                 if glovar.configs[gid].get("sticker"):
                     if sticker_name not in glovar.except_ids["long"]:
-                        if is_regex_text("sti", sticker_name):
+                        if is_regex_hit("sti", sticker_name):
                             return f"del sticker {sticker_name}"
 
                     if sticker_title not in glovar.except_ids["long"]:
-                        if is_regex_text("sti", sticker_title):
+                        if is_regex_hit("sti", sticker_title):
                             return f"del sticker {sticker_title}"
 
             # Check forward from user
@@ -694,7 +756,7 @@ def is_bad_message(client: Client, message: Message, text: str = None, image_pat
                     and message.forward_from.is_bot
                     and message.forward_from.username):
                 if (is_ban_text(message.forward_from.username, False)
-                        or is_regex_text("del", message.forward_from.username, False)):
+                        or is_regex_hit("del", message.forward_from.username, False)):
                     return f"del from {message.forward_from.username}"
 
             # Start detect watch delete
@@ -733,7 +795,7 @@ def is_bad_message(client: Client, message: Message, text: str = None, image_pat
                     if is_wd_text(all_text, False):
                         return "wd ocr"
 
-                color = image_path and get_color(image_path)
+                color = get_image_value(client, image, "color")
 
                 if color:
                     return "wd message"
@@ -742,7 +804,7 @@ def is_bad_message(client: Client, message: Message, text: str = None, image_pat
 
             # Check the message's text
             if message_text:
-                if is_regex_text("bad", message_text):
+                if is_regex_hit("bad", message_text):
                     return "bad message"
 
         # Preview message
@@ -760,19 +822,21 @@ def is_bad_message(client: Client, message: Message, text: str = None, image_pat
             all_text = ""
 
             if image_path:
+                image = get_path_image(image_path)
+
                 # Get QR code
-                qrcode = get_qrcode(image_path)
+                qrcode = get_image_value(client, image, "qrcode")
 
                 if qrcode:
                     if is_ban_text(qrcode, False):
                         return "ban message"
 
-                    if is_regex_text("ad", text) or is_ad_text(text, False):
+                    if is_regex_hit("ad", text) or is_ad_text(text, False):
                         return "ban message"
 
                 # Get OCR
                 if glovar.configs[gid].get("ocr"):
-                    ocr = get_ocr(image_path)
+                    ocr = get_image_value(client, image, "ocr")
 
                     if ocr:
                         if is_ban_text(ocr, True):
@@ -810,20 +874,20 @@ def is_bad_message(client: Client, message: Message, text: str = None, image_pat
 
             # Check the text
             if text:
-                if is_regex_text("del", text):
+                if is_regex_hit("del", text):
                     return "del message"
 
             # Check image
             if qrcode:
-                if is_regex_text("del", qrcode):
+                if is_regex_hit("del", qrcode):
                     return "del message"
 
             if ocr:
-                if is_regex_text("del", ocr, True):
+                if is_regex_hit("del", ocr, True):
                     return "del ocr"
 
             if all_text:
-                if is_regex_text("del", all_text, False):
+                if is_regex_hit("del", all_text, False):
                     return "del ocr"
 
                 if is_contact(all_text):
@@ -852,7 +916,7 @@ def is_bad_message(client: Client, message: Message, text: str = None, image_pat
                     if is_wd_text(all_text, False):
                         return "wd ocr"
 
-                color = image_path and get_color(image_path)
+                color = get_image_value(client, image, "color")
 
                 if color:
                     return "wd message"
@@ -861,13 +925,16 @@ def is_bad_message(client: Client, message: Message, text: str = None, image_pat
 
             # Check the text
             if text:
-                if is_regex_text("bad", text):
+                if is_regex_hit("bad", text):
                     return "bad message"
     except Exception as e:
         logger.warning(f"Is watch message error: {e}", exc_info=True)
     finally:
+        if image.get("path") and image["path"] not in need_delete:
+            need_delete.append(image["path"])
+
         for file in need_delete:
-            thread(delete_file, (file,))
+            thread(delete_file, (file,), pool="file")
 
     return ""
 
@@ -875,11 +942,11 @@ def is_bad_message(client: Client, message: Message, text: str = None, image_pat
 def is_ban_text(text: str, ocr: bool, message: Message = None) -> bool:
     # Check if the text is ban text
     try:
-        if is_regex_text("ban", text, ocr):
+        if is_regex_hit("ban", text, ocr):
             return True
 
         # ad + con
-        ad = is_regex_text("ad", text, ocr)
+        ad = is_regex_hit("ad", text, ocr)
         con = is_con_text(text, ocr)
 
         if ad and con:
@@ -914,7 +981,7 @@ def is_ban_text(text: str, ocr: bool, message: Message = None) -> bool:
 def is_bio_text(text: str) -> bool:
     # Check if the text is bio text
     try:
-        if (is_regex_text("bio", text)
+        if (is_regex_hit("bio", text)
                 or is_ban_text(text, False)):
             return True
     except Exception as e:
@@ -950,11 +1017,8 @@ def is_class_e_user(user: Union[int, User]) -> bool:
         if uid in glovar.bot_ids:
             return True
 
-        group_list = list(glovar.trust_ids)
-
-        for gid in group_list:
-            if uid in glovar.trust_ids.get(gid, set()):
-                return True
+        if glovar.trust_groups.get(uid):
+            return True
     except Exception as e:
         logger.warning(f"Is class e user error: {e}", exc_info=True)
 
@@ -964,9 +1028,9 @@ def is_class_e_user(user: Union[int, User]) -> bool:
 def is_con_text(text: str, ocr: bool) -> bool:
     # Check if the text is con text
     try:
-        if (is_regex_text("con", text, ocr)
-                or is_regex_text("iml", text, ocr)
-                or is_regex_text("pho", text, ocr)):
+        if (is_regex_hit("con", text, ocr)
+                or is_regex_hit("iml", text, ocr)
+                or is_regex_hit("pho", text, ocr)):
             return True
 
         if is_contact(text):
@@ -983,10 +1047,10 @@ def is_contact(text: str) -> str:
         if not text:
             return ""
 
-        text = text.lower()
-        for contact in glovar.bad_ids["contacts"]:
-            if contact.lower() in text:
-                return contact
+        found = get_contacts_found(text, True)
+
+        if found:
+            return found[0]
     except Exception as e:
         logger.warning(f"Is contact error: {e}", exc_info=True)
 
@@ -996,7 +1060,7 @@ def is_contact(text: str) -> str:
 def is_declared_message_id(gid: int, mid: int) -> bool:
     # Check if the message's ID is declared by other bots
     try:
-        if mid in glovar.declared_message_ids.get(gid, set()):
+        if is_window_id("declared_message_ids", gid, mid):
             return True
     except Exception as e:
         logger.warning(f"Is declared message id error: {e}", exc_info=True)
@@ -1013,7 +1077,7 @@ def is_detected_url(message: Message, test: bool = False) -> str:
         links = get_links(message)
 
         for link in links:
-            detected_type = glovar.contents.get(link, "")
+            detected_type = get_content_cache(link)
 
             if detected_type:
                 return detected_type
@@ -1067,16 +1131,7 @@ def is_emoji(the_type: str, text: str, message: Message = None) -> bool:
         if message:
             text = get_text(message, False, False)
 
-        emoji_dict = {}
-        emoji_set = {emoji for emoji in glovar.emoji_set if emoji in text and emoji not in glovar.emoji_protect}
-        emoji_old_set = deepcopy(emoji_set)
-
-        for emoji in emoji_old_set:
-            if any(emoji in emoji_old and emoji != emoji_old for emoji_old in emoji_old_set):
-                emoji_set.discard(emoji)
-
-        for emoji in emoji_set:
-            emoji_dict[emoji] = text.count(emoji)
+        emoji_dict = get_emoji_dict(text)
 
         # Check ad
         if the_type == "ad":
@@ -1275,8 +1330,8 @@ def is_new_user(user: User, now: int, gid: int = 0, joined: bool = False) -> boo
 def is_nm_text(text: str) -> bool:
     # Check if the text is nm text
     try:
-        if (is_regex_text("nm", text)
-                or is_regex_text("bio", text)
+        if (is_regex_hit("nm", text)
+                or is_regex_hit("bio", text)
                 or is_ban_text(text, False)):
             return True
     except Exception as e:
@@ -1306,6 +1361,18 @@ def is_old_user(client: Client, user: User, now: int, gid: int) -> bool:
     return False
 
 
+def is_regex_hit(word_type: str, text: str, ocr: bool = False) -> Optional[Match]:
+    # Check if the text hit the regex rules, share the result with other checks of the same text
+    result = None
+
+    try:
+        result = get_regex_hits(text, ocr, [word_type]).get(word_type)
+    except Exception as e:
+        logger.warning(f"Is regex hit error: {e}", exc_info=True)
+
+    return result
+
+
 def is_restricted_channel(message: Message) -> bool:
     # Check if the message is forwarded form restricted channel
     try:
@@ -1320,43 +1387,33 @@ def is_restricted_channel(message: Message) -> bool:
     return False
 
 
-def is_regex_text(word_type: str, text: str, ocr: bool = False, again: bool = False) -> Optional[Match]:
+def is_regex_text(word_type: str, text: str, ocr: bool = False) -> Optional[Match]:
     # Check if the text hit the regex rules
     result = None
     try:
-        if text:
-            if not again:
-                text = re.sub(r"\s{2,}", " ", text)
-            elif " " in text:
-                text = re.sub(r"\s", "", text)
-            else:
-                return None
-        else:
-            return None
+        word, result = get_regex_text(word_type, text, ocr)
 
-        with glovar.locks["regex"]:
-            words = list(eval(f"glovar.{word_type}_words"))
-
-        for word in words:
-            if ocr and "(?# nocr)" in word:
-                continue
+        # Count and return
+        if result:
+            count_word(word_type, word)
+    except Exception as e:
+        logger.warning(f"Is regex text error: {e}", exc_info=True)
 
-            result = re.search(word, text, re.I | re.S | re.M)
+    return result
 
-            # Count and return
-            if result:
-                count = eval(f"glovar.{word_type}_words").get(word, 0)
-                count += 1
-                eval(f"glovar.{word_type}_words")[word] = count
-                save(f"{word_type}_words")
-                return result
 
-        # Try again
-        return is_regex_text(word_type, text, ocr, True)
+def is_suspicious_user(gid: int, user: User, now: int) -> bool:
+    # Check if the user's messages are checked as watch delete messages, which use the color of the image
+    try:
+        if (is_watch_user(user, "ban", now)
+                or is_high_score_user(user)
+                or is_watch_user(user, "delete", now)
+                or is_limited_user(gid, user, now, glovar.configs.get(gid, {}).get("new"))):
+            return True
     except Exception as e:
-        logger.warning(f"Is regex text error: {e}", exc_info=True)
+        logger.warning(f"Is suspicious user error: {e}", exc_info=True)
 
-    return result
+    return False
 
 
 def is_tgl(client: Client, message: Message, friend: bool = False) -> Union[bool, str]:
@@ -1371,7 +1428,7 @@ def is_tgl(client: Client, message: Message, friend: bool = False) -> Union[bool
         # Check links
         bypass = get_stripped_link(get_channel_link(message))
         links = get_links(message)
-        tg_links = [lk.lower() for lk in links if is_regex_text("tgl", lk)]
+        tg_links = [lk.lower() for lk in links if is_regex_hit("tgl", lk)]
 
         # Define a bypass link filter function
         def is_bypass_link(link: str) -> Union[bool, str]:
@@ -1457,7 +1514,7 @@ def is_tgl(client: Client, message: Message, friend: bool = False) -> Union[bool
         for bypass in bypass_list:
             message_text = message_text.replace(bypass, "")
 
-        if is_regex_text("tgl", message_text):
+        if is_regex_hit("tgl", message_text):
             return True
 
         # Check mentions
@@ -1522,16 +1579,16 @@ def is_watch_user(user: User, the_type: str, now: int) -> bool:
 def is_wb_text(text: str, ocr: bool) -> bool:
     # Check if the text is wb text
     try:
-        if (is_regex_text("wb", text, ocr)
-                or is_regex_text("ad", text, ocr)
-                or is_regex_text("iml", text, ocr)
-                or is_regex_text("pho", text, ocr)
-                or is_regex_text("sho", text, ocr)
-                or is_regex_text("spc", text, ocr)):
+        if (is_regex_hit("wb", text, ocr)
+                or is_regex_hit("ad", text, ocr)
+                or is_regex_hit("iml", text, ocr)
+                or is_regex_hit("pho", text, ocr)
+                or is_regex_hit("sho", text, ocr)
+                or is_regex_hit("spc", text, ocr)):
             return True
 
         for c in ascii_lowercase:
-            if c not in {"i"} and is_regex_text(f"ad{c}", text, ocr):
+            if c not in {"i"} and is_regex_hit(f"ad{c}", text, ocr):
                 return True
     except Exception as e:
         logger.warning(f"Is wb text error: {e}", exc_info=True)
@@ -1542,11 +1599,11 @@ def is_wb_text(text: str, ocr: bool) -> bool:
 def is_wd_text(text: str, ocr: bool) -> bool:
     # Check if the text is wd text
     try:
-        if (is_regex_text("wd", text, ocr)
-                or is_regex_text("adi", text, ocr)
-                or is_regex_text("con", text, ocr)
-                or is_regex_text("spe", text, ocr)
-                or is_regex_text("tgp", text, ocr)):
+        if (is_regex_hit("wd", text, ocr)
+                or is_regex_hit("adi", text, ocr)
+                or is_regex_hit("con", text, ocr)
+                or is_regex_hit("spe", text, ocr)
+                or is_regex_hit("tgp", text, ocr)):
             return True
     except Exception as e:
         logger.warning(f"Is wd text error: {e}", exc_info=True)
@@ -17,15 +17,17 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+from functools import partial
 from typing import Optional
 
 from pyrogram import Client
 from pyrogram.types import Chat, ChatMember, Message
 
 from .. import glovar
-from .etc import code, lang, t2t, thread
+from .cache import get_cache, remove_cache
+from .etc import code, delay, lang, t2t, thread
 from .file import save
-from .ids import init_group_id
+from .ids import init_group_id, update_trust_ids
 from .telegram import delete_messages, get_chat, get_chat_member, leave_chat
 
 # Enable logging
@@ -33,13 +35,22 @@ logger = logging.getLogger(__name__)
 
 
 def delete_message(client: Client, gid: int, mid: int) -> bool:
-    # Delete a single message
+    # Delete a single message, the messages of a group are deleted together in a short while
     try:
         if not gid or not mid:
             return True
 
-        mids = [mid]
-        thread(delete_messages, (client, gid, mids))
+        with glovar.locks["delete"]:
+            mids = glovar.deletions.get(gid)
+
+            # The group's deletions have been scheduled or are being deleted
+            if mids is not None:
+                mids.add(mid)
+                return True
+
+            glovar.deletions[gid] = {mid}
+
+        delay(1, delete_queued_messages, [client, gid])
 
         return True
     except Exception as e:
@@ -48,6 +59,29 @@ def delete_message(client: Client, gid: int, mid: int) -> bool:
     return False
 
 
+def delete_queued_messages(client: Client, gid: int) -> bool:
+    # Delete the queued messages of a group, messages queued during a request are deleted by the next one
+    try:
+        while True:
+            with glovar.locks["delete"]:
+                mids = glovar.deletions.get(gid)
+
+                if not mids:
+                    glovar.deletions.pop(gid, None)
+                    return True
+
+                glovar.deletions[gid] = set()
+
+            delete_messages(client, gid, sorted(mids))
+    except Exception as e:
+        logger.warning(f"Delete queued messages error: {e}", exc_info=True)
+
+        with glovar.locks["delete"]:
+            glovar.deletions.pop(gid, None)
+
+    return False
+
+
 def get_config_text(config: dict) -> str:
     # Get config text
     result = ""
@@ -89,15 +123,7 @@ def get_group(client: Client, gid: int, cache: bool = True) -> Optional[Chat]:
     # Get the group
     result = None
     try:
-        the_cache = glovar.chats.get(gid)
-
-        if cache and the_cache:
-            return the_cache
-
-        result = get_chat(client, gid)
-
-        if result:
-            glovar.chats[gid] = result
+        result = get_cache("chats", gid, partial(get_chat, client, gid), cache)
     except Exception as e:
         logger.warning(f"Get group error: {e}", exc_info=True)
 
@@ -125,15 +151,7 @@ def get_member(client: Client, gid: int, uid: int, cache: bool = True) -> Option
         if not init_group_id(gid):
             return None
 
-        the_cache = glovar.members[gid].get(uid)
-
-        if the_cache:
-            result = the_cache
-        else:
-            result = get_chat_member(client, gid, uid)
-
-        if cache and result:
-            glovar.members[gid][uid] = result
+        result = get_cache("members", (gid, uid), partial(get_chat_member, client, gid, uid), cache)
     except Exception as e:
         logger.warning(f"Get member error: {e}", exc_info=True)
 
@@ -167,15 +185,17 @@ def leave_group(client: Client, gid: int) -> bool:
         glovar.admin_ids.pop(gid, None)
         save("admin_ids")
 
-        glovar.trust_ids.pop(gid, set())
-        save("trust_ids")
+        update_trust_ids(gid, None)
 
         glovar.configs.pop(gid, None)
         save("configs")
 
-        glovar.declared_message_ids.pop(gid, set())
-        glovar.members.pop(gid, {})
-        glovar.recorded_ids.pop(gid, set())
+        with glovar.locks["window"]:
+            glovar.declared_message_ids.pop(gid, None)
+            glovar.recorded_ids.pop(gid, None)
+
+        remove_cache("chats", lambda key: key == gid)
+        remove_cache("members", lambda key: key[0] == gid)
 
         return True
     except Exception as e:
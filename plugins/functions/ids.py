@@ -18,14 +18,116 @@
 
 import logging
 from copy import deepcopy
+from heapq import heapify, heappop, heappush
+from time import time
+from typing import Optional, Set
 
 from .. import glovar
+from .etc import get_user_lock
 from .file import save
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
 
+def add_expiry(kind: str, the_time: int, uid: int, gid: int = 0) -> bool:
+    # Add a timestamp of the user to the expiry index, the replaced or removed timestamps are skipped when popped
+    try:
+        with glovar.locks["expiry"]:
+            heappush(glovar.expiry[kind], (the_time, uid, gid))
+
+        return True
+    except Exception as e:
+        logger.warning(f"Add expiry error: {e}", exc_info=True)
+
+    return False
+
+
+def add_window_id(name: str, gid: int, the_id: int) -> bool:
+    # Add an ID to the group's time window, the oldest bucket of the ring is reused when its time is over
+    try:
+        config = glovar.windows[name]
+        slot = int(time() // config["span"])
+
+        with glovar.locks["window"]:
+            data = eval(f"glovar.{name}")
+            ring = data.get(gid)
+
+            if ring is None:
+                ring = data[gid] = [[0, set()] for _ in range(config["size"])]
+
+            bucket = ring[slot % config["size"]]
+
+            if bucket[0] != slot:
+                bucket[0] = slot
+                bucket[1] = set()
+
+            bucket[1].add(the_id)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Add window id error: {e}", exc_info=True)
+
+    return False
+
+
+def build_expiry() -> bool:
+    # Build the expiry index from the data, should be called at startup and after the data is replaced as a whole
+    try:
+        with glovar.locks["expiry"]:
+            glovar.expiry["join"] = [(the_time, uid, gid) for uid in list(glovar.user_ids)
+                                     for gid, the_time in list(glovar.user_ids[uid]["join"].items())]
+
+            for the_type in ["ban", "delete"]:
+                glovar.expiry[the_type] = [(until, uid, 0) for uid, until in list(glovar.watch_ids[the_type].items())]
+
+            for kind in glovar.expiry:
+                heapify(glovar.expiry[kind])
+
+        return prune_expiry(int(time()))
+    except Exception as e:
+        logger.warning(f"Build expiry error: {e}", exc_info=True)
+
+    return False
+
+
+def build_trust_groups() -> bool:
+    # Build the reverse index of the trusted users from the data, should be called at startup and after rollback
+    try:
+        with glovar.locks["trust"]:
+            trust_groups = {}
+
+            for gid, uids in list(glovar.trust_ids.items()):
+                for uid in list(uids):
+                    trust_groups.setdefault(uid, set()).add(gid)
+
+            glovar.trust_groups = trust_groups
+
+        return True
+    except Exception as e:
+        logger.warning(f"Build trust groups error: {e}", exc_info=True)
+
+    return False
+
+
+def get_new_users(now: int) -> Set[int]:
+    # Get the users who joined any group within the new user time
+    result = set()
+
+    try:
+        prune_expiry(now)
+
+        with glovar.locks["expiry"]:
+            entries = list(glovar.expiry["join"])
+
+        result = {uid for the_time, uid, gid in entries
+                  if glovar.user_ids.get(uid, {}).get("join", {}).get(gid) == the_time}
+    except Exception as e:
+        logger.warning(f"Get new users error: {e}", exc_info=True)
+
+    return result
+
+
 def init_group_id(gid: int) -> bool:
     # Init group data
     try:
@@ -47,15 +149,6 @@ def init_group_id(gid: int) -> bool:
             glovar.configs[gid] = deepcopy(glovar.default_config)
             save("configs")
 
-        if glovar.declared_message_ids.get(gid) is None:
-            glovar.declared_message_ids[gid] = set()
-
-        if glovar.members.get(gid) is None:
-            glovar.members[gid] = {}
-
-        if glovar.recorded_ids.get(gid) is None:
-            glovar.recorded_ids[gid] = set()
-
         return True
     except Exception as e:
         logger.warning(f"Init group id {gid} error: {e}", exc_info=True)
@@ -70,10 +163,95 @@ def init_user_id(uid: int) -> bool:
             return True
 
         glovar.user_ids[uid] = deepcopy(glovar.default_user_status)
-        save("user_ids")
+        save("user_ids", uid)
 
         return True
     except Exception as e:
         logger.warning(f"Init user id {uid} error: {e}", exc_info=True)
 
     return False
+
+
+def prune_expiry(now: int) -> bool:
+    # Pop the expired timestamps from the expiry index, remove the expired watch users
+    try:
+        changed = False
+        expired = []
+
+        with glovar.locks["expiry"]:
+            heap = glovar.expiry["join"]
+
+            while heap and now - heap[0][0] >= glovar.time_new:
+                heappop(heap)
+
+            for the_type in ["ban", "delete"]:
+                heap = glovar.expiry[the_type]
+
+                while heap and heap[0][0] <= now:
+                    until, uid, _ = heappop(heap)
+                    expired.append((the_type, until, uid))
+
+        # The user stripes are taken after the expiry lock is released, the other way round is also used
+        for the_type, until, uid in expired:
+            with get_user_lock(uid):
+                if glovar.watch_ids[the_type].get(uid) != until:
+                    continue
+
+                glovar.watch_ids[the_type].pop(uid, 0)
+                changed = True
+
+        changed and save("watch_ids")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Prune expiry error: {e}", exc_info=True)
+
+    return False
+
+
+def update_trust_ids(gid: int, uids: Optional[Set[int]]) -> bool:
+    # Update the trusted users of a group and the reverse index of them, None means the group is removed
+    try:
+        with glovar.locks["trust"]:
+            old = glovar.trust_ids.get(gid, set())
+            new = uids or set()
+
+            for uid in old - new:
+                groups = glovar.trust_groups.get(uid, set())
+                groups.discard(gid)
+                not groups and glovar.trust_groups.pop(uid, None)
+
+            for uid in new - old:
+                glovar.trust_groups.setdefault(uid, set()).add(gid)
+
+            if uids is None:
+                glovar.trust_ids.pop(gid, set())
+            else:
+                glovar.trust_ids[gid] = uids
+
+        save("trust_ids")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Update trust ids error: {e}", exc_info=True)
+
+    return False
+
+
+def is_window_id(name: str, gid: int, the_id: int) -> bool:
+    # Check if the ID is in the group's time window, the buckets out of the window are ignored
+    try:
+        config = glovar.windows[name]
+        slot = int(time() // config["span"])
+
+        with glovar.locks["window"]:
+            ring = eval(f"glovar.{name}").get(gid)
+
+            if not ring:
+                return False
+
+            return any(slot - bucket[0] < config["size"] and the_id in bucket[1] for bucket in ring)
+    except Exception as e:
+        logger.warning(f"Is window id error: {e}", exc_info=True)
+
+    return False
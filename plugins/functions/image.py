@@ -18,49 +18,26 @@
 
 import logging
 import re
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import active_children, get_context
+from typing import Any, Dict, Iterable, Optional, Union
 
-from PIL import Image, ImageEnhance
 from pyrogram import Client
 from pyrogram.types import Message
-from pytesseract import image_to_string
-from pyzbar.pyzbar import decode
 
 from .. import glovar
+from . import worker
 from .etc import get_md5sum, t2t, thread
-from .file import delete_file, get_downloaded_path
+from .file import delete_file, get_downloaded_path, save
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
 
-def get_color(path: str) -> bool:
-    # Get the picture's color, check if most of it is yellow
-    try:
-        if not path:
-            return False
-
-        image = Image.open(path).convert('YCbCr')
-        w, h = image.size
-        data = image.getdata()
-        cnt = 0
-
-        for i, ycbcr in enumerate(data):
-            y, cb, cr = ycbcr
-
-            if 86 <= cb <= 117 and 140 <= cr <= 168:
-                cnt += 1
-
-        if cnt > w * h * 0.3:
-            return True
-    except Exception as e:
-        logger.warning(f"Get color error: {e}", exc_info=True)
-
-    return False
-
-
-def get_file_id(message: Message) -> (str, bool):
-    # Get media message's image file id
-    file_id = ""
+def get_file(message: Message) -> (Any, bool):
+    # Get media message's image file, and whether it is the full size image
+    result = None
     big = False
     try:
         if (message.photo
@@ -68,20 +45,20 @@ def get_file_id(message: Message) -> (str, bool):
                 or message.document
                 or message.game):
             if message.photo:
-                file_id = message.photo.file_id
+                result = message.photo
             elif message.sticker:
-                file_id = message.sticker.file_id
+                result = message.sticker
             elif message.document:
                 if (message.document.mime_type
                         and "image" in message.document.mime_type
                         and "gif" not in message.document.mime_type
                         and message.document.file_size
                         and message.document.file_size < glovar.image_size):
-                    file_id = message.document.file_id
+                    result = message.document
             elif message.game:
-                file_id = message.game.photo.file_id
+                result = message.game.photo
 
-        if file_id:
+        if result:
             big = True
         elif ((message.animation and message.animation.thumbs)
               or (message.audio and message.audio.thumbs)
@@ -89,126 +66,346 @@ def get_file_id(message: Message) -> (str, bool):
               or (message.video_note and message.video_note.thumbs)
               or (message.document and message.document.thumbs)):
             if message.animation:
-                file_id = message.animation.thumbs[-1].file_id
+                result = message.animation.thumbs[-1]
             elif message.audio:
-                file_id = message.audio.thumbs[-1].file_id
+                result = message.audio.thumbs[-1]
             elif message.video:
-                file_id = message.video.thumbs[-1].file_id
+                result = message.video.thumbs[-1]
             elif message.video_note:
-                file_id = message.video_note.thumbs[-1].file_id
+                result = message.video_note.thumbs[-1]
             elif message.document:
-                file_id = message.document.thumbs[-1].file_id
+                result = message.document.thumbs[-1]
     except Exception as e:
         logger.warning(f"Get image status error: {e}", exc_info=True)
 
-    return file_id, big
+    return result, big
+
+
+def get_file_id(message: Message) -> (str, bool):
+    # Get media message's image file id
+    file, big = get_file(message)
+
+    return (file and file.file_id) or "", big
+
+
+def get_image(client: Client, message: Message, thumb: bool = True) -> Dict[str, Union[bool, str]]:
+    # Get media message's image, the image is only downloaded if its hash is unknown
+    result = {
+        "id": "",
+        "big": False,
+        "hash": "",
+        "path": ""
+    }
+
+    try:
+        file, big = get_file(message)
+
+        if not file or not (big or thumb):
+            return result
+
+        result["id"] = file.file_id
+        result["big"] = big
+
+        # Check the cache
+        unique_id = file.file_unique_id
+        result["hash"] = get_image_cache(unique_id).get("hash", "")
+
+        if result["hash"]:
+            return result
+
+        # Download the image
+        result["path"] = get_downloaded_path(client, file.file_id)
+
+        if not result["path"]:
+            return result
+
+        result["hash"] = get_md5sum("file", result["path"])
+        result["hash"] and set_image_cache(unique_id, {"hash": result["hash"]})
+    except Exception as e:
+        logger.warning(f"Get image error: {e}", exc_info=True)
+
+    return result
+
+
+def get_image_cache(key: str) -> Dict[str, Union[bool, str]]:
+    # Get the cached analysis results of the image
+    result = {}
+
+    try:
+        if not key:
+            return {}
+
+        with glovar.locks["image"]:
+            if glovar.images.get(key) is None:
+                return {}
+
+            glovar.images.move_to_end(key)
+            result = dict(glovar.images[key])
+    except Exception as e:
+        logger.warning(f"Get image cache error: {e}", exc_info=True)
+
+    return result
 
 
 def get_image_hash(client: Client, message: Message) -> str:
     # Get the image's hash
     result = ""
     try:
-        file_id, big = get_file_id(message)
+        image = get_image(client, message)
+        result = image["hash"]
+        image["path"] and thread(delete_file, (image["path"],), pool="file")
+    except Exception as e:
+        logger.warning(f"Get image hash error: {e}", exc_info=True)
 
-        if not file_id:
-            return ""
+    return result
 
-        image_path = get_downloaded_path(client, file_id)
 
-        if not image_path:
-            return ""
+def get_image_job(the_type: str, path: str) -> Optional[Future]:
+    # Submit an analysis job of the image to the worker processes, wait if there are too many jobs
+    result = None
 
-        result = get_md5sum("file", image_path)
-        thread(delete_file, (image_path,))
+    try:
+        if not glovar.image_slots.acquire(timeout=glovar.time_ocr):
+            logger.warning(f"Image job {the_type} of {path} is dropped, the queue is full")
+            return None
+
+        try:
+            if the_type == "color":
+                result = get_image_pool().submit(worker.get_color, path)
+            elif the_type in {"ocr", "ocr_test"}:
+                result = get_image_pool().submit(worker.get_ocr, path)
+            elif the_type == "qrcode":
+                result = get_image_pool().submit(worker.get_qrcode, path)
+        except BrokenProcessPool as e:
+            logger.warning(f"Image pool is broken: {e}")
+            stop_image_pool()
+        finally:
+            if result:
+                glovar.image_jobs.add(result)
+                result.add_done_callback(lambda job: glovar.image_jobs.discard(job) or glovar.image_slots.release())
+            else:
+                glovar.image_slots.release()
     except Exception as e:
-        logger.warning(f"Get image hash error: {e}", exc_info=True)
+        logger.warning(f"Get image job error: {e}", exc_info=True)
 
     return result
 
 
-def get_ocr(path: str, test: bool = False) -> str:
-    result = ""
+def get_image_pool() -> ProcessPoolExecutor:
+    # Get the pool of the worker processes, the workers are forked from a clean server process, not from the bot
+    with glovar.locks["image"]:
+        if glovar.image_pool is None:
+            context = get_context("forkserver")
+            context.set_forkserver_preload([worker.__name__, "pytesseract", "pyzbar.pyzbar"])
+            glovar.image_pool = ProcessPoolExecutor(max_workers=glovar.image_workers, mp_context=context)
+
+        return glovar.image_pool
+
+
+def get_image_value(client: Optional[Client], image: Dict[str, Union[bool, str]], the_type: str) -> Union[bool, str]:
+    # Get the image's analysis result of the type, the result is cached by the image's hash
+    return get_image_values(client, image, [the_type]).get(the_type, "")
+
+
+def get_image_values(client: Optional[Client], image: Dict[str, Union[bool, str]],
+                     types: Iterable[str]) -> Dict[str, Union[bool, str]]:
+    # Get the image's analysis results of the types, the missing ones are analysed in the worker processes together
+    result = {}
+
     try:
-        if not path:
-            return ""
+        if not image or not image["hash"]:
+            return {}
 
-        image = Image.open(path)
-        enhancer = ImageEnhance.Contrast(image)
-        image = enhancer.enhance(2)
-        result = image_to_string(image, lang='chi_sim+chi_tra')
+        cache = get_image_cache(image["hash"])
+        result = {the_type: cache[the_type] for the_type in types if cache.get(the_type) is not None}
+        types = [the_type for the_type in types if the_type not in result]
 
-        if not result:
-            image = image.convert('L')
-            image = get_processed_image(image)
-            result = image_to_string(image, lang='chi_sim+chi_tra')
+        if not types:
+            return result
 
-        if result:
-            if test:
-                result = re.sub(r"\n{2,}", "\n", result)
-            else:
-                result = re.sub(r"\n", " ", result)
+        if not image["path"]:
+            image["path"] = client and image["id"] and get_downloaded_path(client, image["id"])
+
+        if not image["path"]:
+            return result
+
+        jobs = {the_type: get_image_job(the_type, image["path"]) for the_type in types}
+        values = {}
+
+        for the_type in types:
+            value = get_job_result(jobs[the_type], the_type)
 
-            result = re.sub(r"\s{2,}", " ", result)
-            result = t2t(result, False, False)
+            if value is None:
+                continue
+
+            if the_type == "ocr":
+                value = get_ocr_text(value)
+            elif the_type == "ocr_test":
+                value = get_ocr_text(value, True)
+            elif the_type == "qrcode":
+                value = value and t2t(value, False, False)
+
+            values[the_type] = value
+
+        values and set_image_cache(image["hash"], values)
+        result.update(values)
     except Exception as e:
-        logger.warning(f"Get OCR error: {e}", exc_info=True)
+        logger.warning(f"Get image values error: {e}", exc_info=True)
 
     return result
 
 
-def get_processed_image(image: Image.Image) -> Image.Image:
+def get_job_result(job: Optional[Future], the_type: str) -> Union[bool, str, None]:
+    # Get the result of the image job, return None if the job failed
+    result = None
+
     try:
-        image.thumbnail((200, 200))
-        s = 0
-        total = 0
+        if not job:
+            return None
 
-        for count, color in image.getcolors(image.size[0] * image.size[1]):
-            s += count * color
-            total += count
+        result = job.result(timeout=glovar.time_ocr)
+    except TimeoutError:
+        logger.warning(f"Image job {the_type} timeout")
 
-        aver = int(s / total)
+        # A running job can not be cancelled, the hung workers are stopped and the pool is started again
+        job.cancel() or stop_image_pool(job)
+    except Exception as e:
+        logger.warning(f"Get job result error: {e}", exc_info=True)
+
+    return result
+
+
+def get_ocr_text(text: str, test: bool = False) -> str:
+    # Format the OCR text
+    result = text
+
+    try:
+        if not result:
+            return ""
 
-        if aver < 110:
-            image = image.point(lambda x: 0 if x > aver + 20 else 255)
+        if test:
+            result = re.sub(r"\n{2,}", "\n", result)
         else:
-            image = image.point(lambda x: 0 if x < aver - 20 else 255)
+            result = re.sub(r"\n", " ", result)
+
+        result = re.sub(r"\s{2,}", " ", result)
+        result = t2t(result, False, False)
     except Exception as e:
-        logger.warning('Get image error: %s', e)
+        logger.warning(f"Get OCR text error: {e}", exc_info=True)
 
-    return image
+    return result
 
 
-def get_qrcode(path: str) -> str:
-    # Get QR code
-    result = ""
+def get_path_image(path: str) -> Dict[str, Union[bool, str]]:
+    # Get the image of a local file
+    result = {
+        "id": "",
+        "big": True,
+        "hash": "",
+        "path": path
+    }
+
     try:
         if not path:
-            return ""
+            return {}
+
+        result["hash"] = get_md5sum("file", path)
+    except Exception as e:
+        logger.warning(f"Get path image error: {e}", exc_info=True)
+
+    return result
 
-        # Open
-        image = Image.open(path)
 
-        # Gray
-        image = image.convert("L")
+def prepare_image(client: Client, message: Message, color: bool = False) -> bool:
+    # Analyse the message's image before the message is checked, so the check can use the cached results
+    image = {}
 
-        # Contrast
-        image = ImageEnhance.Contrast(image).enhance(4.0)
+    try:
+        if not message.chat or not glovar.configs.get(message.chat.id, {}).get("message"):
+            return True
 
-        # Thresholding
-        image = image.point(lambda x: 0 if x < 150 else 255)
+        image = get_image(client, message, False)
 
-        # Decode
-        decoded_list = decode(image)
+        if not image["hash"] or image["hash"] in glovar.except_ids["temp"]:
+            return True
 
-        if decoded_list:
-            for decoded in decoded_list:
-                if decoded.type == "QRCODE":
-                    result += f"{decoded.data}\n"
+        types = ["qrcode"]
+        glovar.configs[message.chat.id].get("ocr") and types.append("ocr")
+        color and types.append("color")
+        get_image_values(client, image, types)
 
-            if result:
-                result = result[:-1]
-                result = t2t(result, False, False)
+        return True
     except Exception as e:
-        logger.warning(f"Get qrcode error: {e}", exc_info=True)
+        logger.warning(f"Prepare image error: {e}", exc_info=True)
+    finally:
+        image.get("path") and thread(delete_file, (image["path"],), pool="file")
 
-    return result
+    return False
+
+
+def set_image_cache(key: str, values: Dict[str, Union[bool, str]]) -> bool:
+    # Cache the analysis results of the image, the least recently used images are removed
+    try:
+        if not key:
+            return False
+
+        with glovar.locks["image"]:
+            glovar.images.setdefault(key, {}).update(values)
+            glovar.images.move_to_end(key)
+
+            while len(glovar.images) > glovar.limit_image:
+                glovar.images.popitem(last=False)
+
+        save("images")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Set image cache error: {e}", exc_info=True)
+
+    return False
+
+
+def start_image_pool() -> bool:
+    # Start the worker processes at startup, so the first images do not wait for them
+    try:
+        get_image_pool().submit(int).result()
+
+        return True
+    except Exception as e:
+        logger.warning(f"Start image pool error: {e}", exc_info=True)
+
+    return False
+
+
+def stop_image_pool(job: Optional[Future] = None) -> bool:
+    # Stop the worker processes, the other jobs are cancelled or fail, a new pool is started by the next job
+    try:
+        with glovar.locks["image"]:
+            pool = glovar.image_pool
+
+            if pool is None:
+                return True
+
+            # The job's pool may have been stopped already
+            if job and job not in glovar.image_jobs:
+                return True
+
+            glovar.image_pool = None
+            jobs = list(glovar.image_jobs)
+
+            # The executor has no public way to stop a running job, its workers are the only child processes
+            processes = active_children()
+
+        for future in jobs:
+            future.cancel()
+
+        for process in processes:
+            process.terminate()
+
+        pool.shutdown(wait=False)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Stop image pool error: {e}", exc_info=True)
+
+    return False
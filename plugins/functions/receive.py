@@ -27,15 +27,19 @@ from pyrogram import Client
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup, Message
 
 from .. import glovar
-from .channel import ask_for_help, auto_report, declare_message, get_content, get_debug_text, send_debug, share_data
-from .etc import code, crypt_str, delay, general_link, get_int, get_now, get_report_record
-from .etc import get_stripped_link, get_text, lang, mention_id, message_link, t2t, thread
+from .channel import ask_for_help, auto_report, declare_message, get_content, get_debug_text, send_debug
+from .channel import set_content_cache, share_data
+from .etc import code, crypt_str, delay, general_link, get_int, get_now, get_percentile, get_report_record
+from .etc import get_stripped_link, get_text, get_user_lock, lang, lock_users, mention_id, message_link, set_t2t_table
+from .etc import t2t, thread
 from .file import crypt_file, data_to_file, delete_file, get_new_path, get_downloaded_path, save
 from .filters import is_avatar_image, is_bad_message, is_ban_text, is_bio_text, is_class_e, is_contact
-from .filters import is_declared_message_id, is_detected_user_id, is_from_user, is_nm_text, is_regex_text, is_wb_text
+from .filters import is_declared_message_id, is_detected_user_id, is_from_user, is_nm_text, is_regex_hit, is_wb_text
 from .group import delete_message, get_config_text, leave_group
-from .ids import init_group_id, init_user_id
+from .ids import add_expiry, add_window_id, build_expiry, build_trust_groups, get_new_users, init_group_id
+from .ids import init_user_id
 from .image import get_image_hash
+from .regex import compile_words
 from .telegram import get_messages, get_user_full, send_message, send_photo, send_report_message
 from .timers import update_admins
 from .user import add_bad_user, ban_user, global_delete_score, global_delete_watch
@@ -58,7 +62,8 @@ def receive_add_bad(client: Client, sender: str, data: dict) -> bool:
 
         # Receive bad user
         if the_type == "user":
-            glovar.bad_ids["users"].add(the_id)
+            with get_user_lock(the_id):
+                glovar.bad_ids["users"].add(the_id)
 
         # Receive bad content
         if sender == "MANAGE" and the_type == "content":
@@ -188,7 +193,7 @@ def receive_add_except(client: Client, data: dict) -> bool:
                 glovar.except_ids[the_type].add(content)
                 glovar.bad_ids["contents"].discard(content)
                 save("bad_ids")
-                glovar.contents.pop(content, "")
+                set_content_cache(content)
 
             image_hash = get_image_hash(client, message)
 
@@ -207,7 +212,8 @@ def receive_add_except(client: Client, data: dict) -> bool:
 def receive_avatar(client: Client, message: Message, data: dict) -> bool:
     # Receive avatar
     image_path = ""
-    glovar.locks["message"].acquire()
+    lock = get_user_lock(data["user_id"])
+    lock.acquire()
     try:
         # Basic data
         gid = data["group_id"]
@@ -314,14 +320,14 @@ def receive_avatar(client: Client, message: Message, data: dict) -> bool:
             text += (f"{lang('user_id')}{lang('colon')}{code(uid)}\n"
                      f"{lang('action')}{lang('colon')}{code(lang('avatar_ban'))}\n"
                      f"{lang('evidence')}{lang('colon')}{general_link(result.message_id, message_link(result))}\n")
-            thread(send_message, (client, glovar.debug_channel_id, text))
+            thread(send_message, (client, glovar.debug_channel_id, text), pool="log")
 
         return True
     except Exception as e:
         logger.warning(f"Receive avatar error: {e}", exc_info=True)
     finally:
-        thread(delete_file, (image_path,))
-        glovar.locks["message"].release()
+        thread(delete_file, (image_path,), pool="file")
+        lock.release()
 
     return False
 
@@ -330,7 +336,8 @@ def receive_captcha_kicked_user(data: dict) -> bool:
     # Receive CAPTCHA kicked user
     result = False
 
-    glovar.locks["message"].acquire()
+    lock = get_user_lock(data["user_id"])
+    lock.acquire()
 
     try:
         # Basic data
@@ -346,13 +353,13 @@ def receive_captcha_kicked_user(data: dict) -> bool:
             return True
 
         glovar.user_ids[uid]["join"].pop(gid, 0)
-        save("user_ids")
+        save("user_ids", uid)
 
         result = True
     except Exception as e:
         logger.warning(f"Receive captcha kicked user error: {e}", exc_info=True)
     finally:
-        glovar.locks["message"].release()
+        lock.release()
 
     return result
 
@@ -361,8 +368,6 @@ def receive_captcha_kicked_users(client: Client, message: Message, data: int) ->
     # Receive CAPTCHA kicked users
     result = False
 
-    glovar.locks["message"].acquire()
-
     try:
         # Basic data
         gid = data
@@ -376,87 +381,91 @@ def receive_captcha_kicked_users(client: Client, message: Message, data: int) ->
 
         # Remove group status
         for uid in uids:
-            glovar.user_ids.get(uid, {}) and glovar.user_ids[uid]["join"].pop(gid, 0)
+            with get_user_lock(uid):
+                if not glovar.user_ids.get(uid, {}):
+                    continue
+
+                glovar.user_ids[uid]["join"].pop(gid, 0)
 
-        save("user_ids")
+            save("user_ids", uid)
 
         result = True
     except Exception as e:
         logger.warning(f"Receive captcha kicked users error: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
 
     return result
 
 
 def receive_clear_data(client: Client, data_type: str, data: dict) -> bool:
     # Receive clear data command
-    glovar.locks["message"].acquire()
     try:
         # Basic data
         aid = data["admin_id"]
         the_type = data["type"]
 
-        # Clear bad data
-        if data_type == "bad":
-            if the_type == "channels":
-                glovar.bad_ids["channels"] = set()
-            elif the_type == "contacts":
-                glovar.bad_ids["contacts"] = set()
-            elif the_type == "contents":
-                glovar.bad_ids["contents"] = set()
-            elif the_type == "users":
-                glovar.bad_ids["users"] = set()
-
-            save("bad_ids")
-
-        # Clear except data
-        if data_type == "except":
-            if the_type == "channels":
-                glovar.except_ids["channels"] = set()
-            elif the_type == "contacts":
-                glovar.except_ids["contacts"] = set()
-            elif the_type == "long":
-                glovar.except_ids["long"] = set()
-            elif the_type == "temp":
-                glovar.except_ids["temp"] = set()
-
-            save("except_ids")
-
-        # Clear user data
-        if data_type == "user":
-            if the_type == "all":
-                glovar.user_ids = {}
-            elif the_type == "new":
-                for uid in list(glovar.user_ids):
-                    glovar.user_ids[uid]["join"] = {}
-
-            save("user_ids")
-
-        # Clear watch data
-        if data_type == "watch":
-            if the_type == "all":
-                glovar.watch_ids = {
-                    "ban": {},
-                    "delete": {}
-                }
-            elif the_type == "ban":
-                glovar.watch_ids["ban"] = {}
-            elif the_type == "delete":
-                glovar.watch_ids["delete"] = {}
+        # Stop the message checks while the data is cleared
+        with lock_users():
+            # Clear bad data
+            if data_type == "bad":
+                if the_type == "channels":
+                    glovar.bad_ids["channels"] = set()
+                elif the_type == "contacts":
+                    glovar.bad_ids["contacts"] = set()
+                elif the_type == "contents":
+                    glovar.bad_ids["contents"] = set()
+                elif the_type == "users":
+                    glovar.bad_ids["users"] = set()
 
-            save("watch_ids")
+                save("bad_ids")
+
+            # Clear except data
+            if data_type == "except":
+                if the_type == "channels":
+                    glovar.except_ids["channels"] = set()
+                elif the_type == "contacts":
+                    glovar.except_ids["contacts"] = set()
+                elif the_type == "long":
+                    glovar.except_ids["long"] = set()
+                elif the_type == "temp":
+                    glovar.except_ids["temp"] = set()
+
+                save("except_ids")
+
+            # Clear user data
+            if data_type == "user":
+                if the_type == "all":
+                    glovar.user_ids = {}
+                elif the_type == "new":
+                    for uid in list(glovar.user_ids):
+                        glovar.user_ids[uid]["join"] = {}
+
+                save("user_ids")
+
+            # Clear watch data
+            if data_type == "watch":
+                if the_type == "all":
+                    glovar.watch_ids = {
+                        "ban": {},
+                        "delete": {}
+                    }
+                elif the_type == "ban":
+                    glovar.watch_ids["ban"] = {}
+                elif the_type == "delete":
+                    glovar.watch_ids["delete"] = {}
+
+                save("watch_ids")
+
+        # Index the remaining timestamps
+        data_type in {"user", "watch"} and build_expiry()
 
         # Send debug message
         text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
                 f"{lang('admin_project')}{lang('colon')}{mention_id(aid)}\n"
                 f"{lang('action')}{lang('colon')}{code(lang('clear'))}\n"
                 f"{lang('more')}{lang('colon')}{code(f'{data_type} {the_type}')}\n")
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="log")
     except Exception as e:
         logger.warning(f"Receive clear data: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
 
     return False
 
@@ -560,7 +569,7 @@ def receive_declared_message(data: dict) -> bool:
             return True
 
         if init_group_id(gid):
-            glovar.declared_message_ids[gid].add(mid)
+            add_window_id("declared_message_ids", gid, mid)
 
         return True
     except Exception as e:
@@ -596,7 +605,7 @@ def receive_file_data(client: Client, message: Message, decrypt: bool = True) ->
             data = pickle.load(f)
 
         for f in {path, path_decrypted}:
-            thread(delete_file, (f,))
+            thread(delete_file, (f,), pool="file")
     except Exception as e:
         logger.warning(f"Receive file error: {e}", exc_info=True)
 
@@ -607,8 +616,6 @@ def receive_flood_score(client: Client, message: Message) -> bool:
     # Receive flood users' score
     result = False
 
-    glovar.locks["message"].acquire()
-
     try:
         users = receive_file_data(client, message)
 
@@ -618,13 +625,12 @@ def receive_flood_score(client: Client, message: Message) -> bool:
         user_list = [uid for uid in list(users) if init_user_id(uid)]
 
         for uid in user_list:
-            glovar.user_ids[uid]["score"]["captcha"] = users[uid]
+            with get_user_lock(uid):
+                glovar.user_ids[uid]["score"]["captcha"] = users[uid]
 
-        save("user_ids")
+            save("user_ids", uid)
     except Exception as e:
         logger.warning(f"Receive flood score error: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
 
     return result
 
@@ -681,7 +687,7 @@ def receive_help_check(client: Client, message: Message, data: dict) -> bool:
                         return terminate_user(client, the_message, the_user, "ban nick record")
                     elif is_contact(t2t_name):
                         return terminate_user(client, the_message, the_user, "ban nick contact")
-                    elif is_regex_text("wb", t2t_name) and is_regex_text("sho", t2t_name):
+                    elif is_regex_hit("wb", t2t_name) and is_regex_hit("sho", t2t_name):
                         return terminate_user(client, the_message, the_user, "ban nick")
 
             # Check bio
@@ -746,7 +752,7 @@ def receive_leave_approve(client: Client, data: dict) -> bool:
             text += f"{lang('reason')}{lang('colon')}{code(reason)}\n"
 
         leave_group(client, the_id)
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="log")
 
         return True
     except Exception as e:
@@ -757,7 +763,8 @@ def receive_leave_approve(client: Client, data: dict) -> bool:
 
 def receive_preview(client: Client, message: Message, data: dict) -> bool:
     # Receive message's preview
-    glovar.locks["message"].acquire()
+    lock = get_user_lock(data["user_id"])
+    lock.acquire()
     try:
         # Basic data
         gid = data["group_id"]
@@ -811,13 +818,13 @@ def receive_preview(client: Client, message: Message, data: dict) -> bool:
             result = terminate_user(client, the_message, the_message.from_user, detection)
 
             if result and url and detection != "true":
-                glovar.contents[url] = detection
+                set_content_cache(url, detection)
 
         return True
     except Exception as e:
         logger.warning(f"Receive preview error: {e}", exc_info=True)
     finally:
-        glovar.locks["message"].release()
+        lock.release()
 
     return False
 
@@ -835,7 +842,7 @@ def receive_refresh(client: Client, data: int) -> bool:
         text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
                 f"{lang('admin_project')}{lang('colon')}{mention_id(aid)}\n"
                 f"{lang('action')}{lang('colon')}{code(lang('refresh'))}\n")
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="log")
 
         return True
     except Exception as e:
@@ -860,21 +867,17 @@ def receive_regex(client: Client, message: Message, data: str) -> bool:
         if words_data is None:
             return True
 
-        pop_set = set(eval(f"glovar.{file_name}")) - set(words_data)
-        new_set = set(words_data) - set(eval(f"glovar.{file_name}"))
-
-        for word in pop_set:
-            eval(f"glovar.{file_name}").pop(word, 0)
-
-        for word in new_set:
-            eval(f"glovar.{file_name}")[word] = 0
-
+        # Publish a new rule set instead of changing the one being read, keep the order of the remaining rules
+        new_words = set(words_data)
+        words = {word: 0 for word in eval(f"glovar.{file_name}") if word in new_words}
+        words.update({word: 0 for word in words_data if word not in words})
+        setattr(glovar, file_name, words)
         save(file_name)
 
         # Regenerate special characters dictionary if possible
         if file_name in {"spc_words", "spe_words"}:
             special = file_name.split("_")[0]
-            exec(f"glovar.{special}_dict = {{}}")
+            special_dict = {}
 
             for rule in words_data:
                 # Check keys
@@ -889,7 +892,17 @@ def receive_regex(client: Client, message: Message, data: str) -> bool:
                 value = rule.split("?#")[1][1]
 
                 for k in keys:
-                    eval(f"glovar.{special}_dict")[k] = value
+                    special_dict[k] = value
+
+            setattr(glovar, f"{special}_dict", special_dict)
+            set_t2t_table()
+
+        # Recompile the rules
+        compile_words(word_type)
+
+        # Clear the hit vectors of checked texts
+        with glovar.locks["hits"]:
+            glovar.hits = {}
 
         return True
     except Exception as e:
@@ -918,7 +931,7 @@ def receive_remove_bad(client: Client, data: dict) -> bool:
             glovar.watch_ids["delete"].pop(the_id, {})
             save("watch_ids")
             glovar.user_ids[the_id] = deepcopy(glovar.default_user_status)
-            save("user_ids")
+            save("user_ids", the_id)
 
         # Remove bad contact
         if the_type == "contact":
@@ -1045,7 +1058,8 @@ def receive_remove_except(client: Client, data: dict) -> bool:
 
 def receive_remove_score(data: int) -> bool:
     # Receive remove user's score
-    glovar.locks["message"].acquire()
+    lock = get_user_lock(data)
+    lock.acquire()
     try:
         # Basic data
         uid = data
@@ -1054,13 +1068,13 @@ def receive_remove_score(data: int) -> bool:
             return True
 
         glovar.user_ids[uid] = deepcopy(glovar.default_user_status)
-        save("user_ids")
+        save("user_ids", uid)
 
         return True
     except Exception as e:
         logger.warning(f"Receive remove score error: {e}", exc_info=True)
     finally:
-        glovar.locks["message"].release()
+        lock.release()
 
     return False
 
@@ -1109,20 +1123,29 @@ def receive_rollback(client: Client, message: Message, data: dict) -> bool:
         # Basic data
         aid = data["admin_id"]
         the_type = data["type"]
+        if the_type not in glovar.file_list:
+            return True
+
         the_data = receive_file_data(client, message)
 
         if not the_data:
             return True
 
-        exec(f"glovar.{the_type} = the_data")
+        with lock_users():
+            exec(f"glovar.{the_type} = the_data")
+
         save(the_type)
 
+        # Index the restored data
+        the_type in {"user_ids", "watch_ids"} and build_expiry()
+        the_type == "trust_ids" and build_trust_groups()
+
         # Send debug message
         text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
                 f"{lang('admin_project')}{lang('colon')}{mention_id(aid)}\n"
                 f"{lang('action')}{lang('colon')}{code(lang('rollback'))}\n"
                 f"{lang('more')}{lang('colon')}{code(the_type)}\n")
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="log")
     except Exception as e:
         logger.warning(f"Receive rollback error: {e}", exc_info=True)
 
@@ -1131,24 +1154,41 @@ def receive_rollback(client: Client, message: Message, data: dict) -> bool:
 
 def receive_status_ask(client: Client, data: dict) -> bool:
     # Receive version info request
-    glovar.locks["message"].acquire()
     try:
         # Basic data
         aid = data["admin_id"]
         mid = data["message_id"]
         now = get_now()
 
-        new_count = 0
+        new_count = len(get_new_users(now))
+
         bad_count = len(glovar.bad_ids["users"])
-        user_ids = deepcopy(glovar.user_ids)
+        save_delays = list(glovar.save_delays)
+
+        with glovar.locks["pool"]:
+            pools = " / ".join(f"{pool} {stats['pending']} ({stats['peak']}, {stats['overflow']})"
+                               for pool, stats in glovar.pools.items())
+
+        with glovar.locks["content"]:
+            contents = (f"{len(glovar.contents)} "
+                        f"({glovar.content_stats['hit']}, {glovar.content_stats['miss']})")
 
-        for uid in user_ids:
-            if any([now - user_ids[uid]["join"][gid] < glovar.time_new for gid in user_ids[uid]["join"]]):
-                new_count += 1
+        with glovar.locks["recheck"]:
+            recheck = (f"{new_count} {lang('members')} "
+                       f"({glovar.recheck['done']}/{glovar.recheck['total']}, {glovar.recheck['lag']})")
+
+        with glovar.locks["limit"]:
+            limits = " / ".join(f"{kind} {limit['waiting']} ({limit['floods']})"
+                                for kind, limit in glovar.limits.items() if limit["waiting"] or limit["floods"])
 
         status = {
-            lang("nick_recheck"): f"{new_count} {lang('members')}",
-            lang("blacklist"): f"{bad_count} {lang('members')}"
+            lang("nick_recheck"): recheck,
+            lang("blacklist"): f"{bad_count} {lang('members')}",
+            lang("save_delay"): (f"p50 {get_percentile(save_delays, 50):.1f}s / "
+                                 f"p99 {get_percentile(save_delays, 99):.1f}s"),
+            lang("content_cache"): contents,
+            lang("thread_pool"): pools,
+            lang("rate_limit"): limits or "0"
         }
         file = data_to_file(status)
         share_data(
@@ -1166,8 +1206,6 @@ def receive_status_ask(client: Client, data: dict) -> bool:
         return True
     except Exception as e:
         logger.warning(f"Receive version ask error: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
 
     return False
 
@@ -1190,7 +1228,8 @@ def receive_text_data(message: Message) -> dict:
 
 def receive_user_score(client: Client, project: str, data: dict, captcha: bool = False) -> bool:
     # Receive and update user's score
-    glovar.locks["message"].acquire()
+    lock = get_user_lock(data["id"])
+    lock.acquire()
     try:
         # Basic data
         project = project.lower()
@@ -1201,7 +1240,7 @@ def receive_user_score(client: Client, project: str, data: dict, captcha: bool =
 
         score = data["score"]
         glovar.user_ids[uid]["score"][project] = score
-        save("user_ids")
+        save("user_ids", uid)
 
         # Global delete
         if captcha:
@@ -1213,7 +1252,7 @@ def receive_user_score(client: Client, project: str, data: dict, captcha: bool =
     except Exception as e:
         logger.warning(f"Receive user score error: {e}", exc_info=True)
     finally:
-        glovar.locks["message"].release()
+        lock.release()
 
     return False
 
@@ -1232,7 +1271,10 @@ def receive_watch_user(client: Client, data: dict, from_watch: bool = False) ->
 
         # Add to list
         if the_type == "ban":
-            glovar.watch_ids["ban"][uid] = until
+            with get_user_lock(uid):
+                glovar.watch_ids["ban"][uid] = until
+
+            add_expiry("ban", until, uid)
 
             # Global delete
             if not from_watch:
@@ -1243,7 +1285,10 @@ def receive_watch_user(client: Client, data: dict, from_watch: bool = False) ->
             delay(10, global_delete_watch, [client, uid, mid])
 
         elif the_type == "delete":
-            glovar.watch_ids["delete"][uid] = until
+            with get_user_lock(uid):
+                glovar.watch_ids["delete"][uid] = until
+
+            add_expiry("delete", until, uid)
         else:
             return False
 
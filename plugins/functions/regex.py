@@ -0,0 +1,388 @@
+# SCP-079-NOSPAM - Block spam in groups
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-NOSPAM.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import re
+from collections import deque
+from typing import Any, Dict, Iterable, List, Match, Optional, Pattern, Tuple
+
+from .. import glovar
+from .file import save
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+# Regex flags used by all rules
+flags = re.I | re.S | re.M
+
+
+def compile_contacts() -> Dict[str, Any]:
+    # Compile the bad contacts into an Aho-Corasick automaton
+    result = {}
+
+    try:
+        contacts = glovar.bad_ids["contacts"]
+        # Trie, each node keeps the contacts ending there
+        goto = [{}]
+        out = [[]]
+
+        for contact in contacts.copy():
+            if not contact:
+                continue
+
+            node = 0
+
+            for char in contact.lower():
+                if char not in goto[node]:
+                    goto.append({})
+                    out.append([])
+                    goto[node][char] = len(goto) - 1
+
+                node = goto[node][char]
+
+            out[node].append(contact)
+
+        # Failure links, in breadth-first order
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+
+        while queue:
+            node = queue.popleft()
+
+            for char, child in goto[node].items():
+                state = fail[node]
+
+                while state and char not in goto[state]:
+                    state = fail[state]
+
+                fail[child] = goto[state].get(char, 0) if node else 0
+                out[child] = out[child] + out[fail[child]]
+                queue.append(child)
+
+        result = {
+            "contacts": contacts,
+            "size": len(contacts),
+            "goto": goto,
+            "fail": fail,
+            "out": out
+        }
+        glovar.contact_matcher = result
+    except Exception as e:
+        logger.warning(f"Compile contacts error: {e}", exc_info=True)
+
+    return result
+
+
+def compile_emoji() -> Dict[str, Any]:
+    # Compile the emoji set into a trie and a pattern of the runs of emoji characters
+    result = {}
+
+    try:
+        emojis = {emoji for emoji in glovar.emoji_set if emoji and emoji not in glovar.emoji_protect}
+        trie = {}
+
+        for emoji in emojis:
+            node = trie
+
+            for char in emoji:
+                node = node.setdefault(char, {})
+
+            node[""] = {}
+
+        result = {
+            "pattern": re.compile(f"[{get_char_class(c for e in emojis for c in e)}]+") if emojis else None,
+            "trie": trie
+        }
+        glovar.emoji_tokenizer = result
+    except Exception as e:
+        logger.warning(f"Compile emoji error: {e}", exc_info=True)
+
+    return result
+
+
+def compile_mode(patterns: List[Optional[Pattern]], indexes: List[int]) -> Dict[str, Any]:
+    # Compile the rules of one mode into a combined pattern, which only tells if any of its rules matches
+    result = {
+        "combined": None,
+        "indexes": indexes,
+        "alone": []
+    }
+
+    try:
+        combined = []
+
+        for i in indexes:
+            # Named groups of every rule make each failed branch restore all the group marks
+            if is_combinable(patterns[i]):
+                combined.append(f"(?:{patterns[i].pattern})")
+            else:
+                result["alone"].append(i)
+
+        if not combined:
+            return result
+
+        try:
+            result["combined"] = re.compile("|".join(combined), flags)
+        except Exception as e:
+            logger.warning(f"Compile combined pattern error: {e}")
+            result["alone"] = indexes
+    except Exception as e:
+        logger.warning(f"Compile mode error: {e}", exc_info=True)
+
+    return result
+
+
+def compile_words(word_type: str) -> Dict[str, Any]:
+    # Compile a type of regex rules into a new snapshot, should be called at startup or with the regex lock
+    result = {}
+
+    try:
+        words = list(eval(f"glovar.{word_type}_words"))
+        patterns = []
+
+        for word in words:
+            try:
+                patterns.append(re.compile(word, flags))
+            except Exception as e:
+                logger.warning(f"Compile {word_type} rule {word} error: {e}")
+                patterns.append(None)
+
+        valid = [i for i in range(len(words)) if patterns[i]]
+
+        result = {
+            "words": words,
+            "patterns": patterns,
+            "all": compile_mode(patterns, valid),
+            "ocr": compile_mode(patterns, [i for i in valid if "(?# nocr)" not in words[i]])
+        }
+        glovar.compiled[word_type] = result
+    except Exception as e:
+        logger.warning(f"Compile words error: {e}", exc_info=True)
+
+    return result
+
+
+def count_word(word_type: str, word: str) -> bool:
+    # Count a hit of the rule in memory
+    try:
+        with glovar.locks["count"]:
+            counts = glovar.counts.setdefault(word_type, {})
+            counts[word] = counts.get(word, 0) + 1
+            glovar.counts_changed = True
+
+        return True
+    except Exception as e:
+        logger.warning(f"Count word error: {e}", exc_info=True)
+
+    return False
+
+
+def flush_counts() -> bool:
+    # Save the hit counts if they have been changed
+    try:
+        with glovar.locks["count"]:
+            if not glovar.counts_changed:
+                return True
+
+            glovar.counts_changed = False
+
+        return save("counts")
+    except Exception as e:
+        logger.warning(f"Flush counts error: {e}", exc_info=True)
+
+    return False
+
+
+def get_char_class(chars: Iterable[str]) -> str:
+    # Get the content of a character class, continuous characters are merged into ranges
+    result = ""
+
+    try:
+        points = sorted({ord(char) for char in chars})
+        ranges = []
+
+        for point in points:
+            if ranges and ranges[-1][1] == point - 1:
+                ranges[-1][1] = point
+            else:
+                ranges.append([point, point])
+
+        result = "".join(re.escape(chr(start)) + (end > start and f"-{re.escape(chr(end))}" or "")
+                         for start, end in ranges)
+    except Exception as e:
+        logger.warning(f"Get char class error: {e}", exc_info=True)
+
+    return result
+
+
+def get_contacts_found(text: str, first: bool = False) -> List[str]:
+    # Get the bad contacts in the text with one scan, the automaton is rebuilt if the contacts have been changed
+    result = []
+
+    try:
+        if not text:
+            return []
+
+        matcher = glovar.contact_matcher
+        contacts = glovar.bad_ids["contacts"]
+
+        if not matcher or matcher["contacts"] is not contacts or matcher["size"] != len(contacts):
+            matcher = compile_contacts()
+
+        goto = matcher["goto"]
+        fail = matcher["fail"]
+        out = matcher["out"]
+        state = 0
+
+        for char in text.lower():
+            while state and char not in goto[state]:
+                state = fail[state]
+
+            state = goto[state].get(char, 0)
+
+            if not out[state]:
+                continue
+
+            result += [contact for contact in out[state] if contact not in result]
+
+            if first:
+                break
+    except Exception as e:
+        logger.warning(f"Get contacts found error: {e}", exc_info=True)
+
+    return result
+
+
+def get_compiled(word_type: str) -> Dict[str, Any]:
+    # Get the compiled snapshot of a type of rules, snapshots are replaced as a whole and never changed in place
+    result = {}
+
+    try:
+        result = glovar.compiled.get(word_type)
+
+        if result is not None:
+            return result
+
+        with glovar.locks["regex"]:
+            result = glovar.compiled.get(word_type)
+
+            if result is None:
+                result = compile_words(word_type)
+    except Exception as e:
+        logger.warning(f"Get compiled error: {e}", exc_info=True)
+
+    return result or {}
+
+
+def get_emoji_dict(text: str) -> Dict[str, int]:
+    # Get the count of each emoji in the text, the longest emoji is taken at each position
+    result = {}
+
+    try:
+        tokenizer = glovar.emoji_tokenizer or compile_emoji()
+
+        if not text or not tokenizer.get("pattern"):
+            return {}
+
+        trie = tokenizer["trie"]
+
+        for run in tokenizer["pattern"].findall(text):
+            i = 0
+
+            while i < len(run):
+                node = trie
+                end = 0
+
+                for j in range(i, len(run)):
+                    node = node.get(run[j])
+
+                    if node is None:
+                        break
+
+                    if "" in node:
+                        end = j + 1
+
+                if not end:
+                    i += 1
+                    continue
+
+                emoji = run[i:end]
+                result[emoji] = result.get(emoji, 0) + 1
+                i = end
+    except Exception as e:
+        logger.warning(f"Get emoji dict error: {e}", exc_info=True)
+
+    return result
+
+
+def get_regex_match(word_type: str, text: str, ocr: bool = False) -> Tuple[str, Optional[Match]]:
+    # Get the first matched rule in the type's order and its match object
+    try:
+        engine = get_compiled(word_type)
+
+        if not engine:
+            return "", None
+
+        words = engine["words"]
+        patterns = engine["patterns"]
+        mode = engine[(lambda x: "ocr" if x else "all")(ocr)]
+
+        # One scan with the combined pattern, only the rules out of it are left if it does not match
+        combined = mode["combined"]
+
+        if combined and combined.search(text):
+            candidates = mode["indexes"]
+        else:
+            candidates = mode["alone"]
+
+        for i in candidates:
+            result = patterns[i].search(text)
+
+            if result:
+                return words[i], result
+    except Exception as e:
+        logger.warning(f"Get regex match error: {e}", exc_info=True)
+
+    return "", None
+
+
+def is_combinable(pattern: Optional[Pattern]) -> bool:
+    # Check if the rule can be put into a combined pattern without changing its meaning
+    try:
+        if not pattern:
+            return False
+
+        word = pattern.pattern
+
+        # Named groups may be redefined by other rules
+        if pattern.groupindex:
+            return False
+
+        # Group references will point to other groups
+        if pattern.groups and re.search(r"\\[1-9]|\(\?P=|\(\?\(", word):
+            return False
+
+        # Global flags are only allowed at the start of the whole expression
+        if re.match(r"\(\?[aiLmsux]+\)", word):
+            return False
+
+        return True
+    except Exception as e:
+        logger.warning(f"Is combinable error: {e}", exc_info=True)
+
+    return False
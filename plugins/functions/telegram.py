@@ -17,7 +17,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from typing import Iterable, List, Optional, Union
+from functools import partial
+from typing import Dict, Iterable, List, Optional, Union
 
 from pyrogram import Client
 from pyrogram.raw.functions.messages import GetStickerSet
@@ -31,8 +32,9 @@ from pyrogram.types import Chat, ChatMember, ChatPermissions, ChatPreview, Inlin
 from pyrogram.raw.base import InputChannel, InputUser, InputPeer
 
 from .. import glovar
+from .cache import get_cache
 from .decorators import retry
-from .etc import delay, get_int, t2t, wait_flood
+from .etc import delay, get_int, t2t, wait_flood, wait_token
 
 # Enable logging
 logger = logging.getLogger(__name__)
@@ -51,10 +53,11 @@ def delete_messages(client: Client, cid: int, mids: Iterable[int]) -> Optional[b
                 while flood_wait:
                     flood_wait = False
                     try:
+                        wait_token("delete")
                         result = client.delete_messages(chat_id=cid, message_ids=mids)
                     except FloodWait as e:
                         flood_wait = True
-                        wait_flood(e)
+                        wait_flood(e, "delete")
             except MessageDeleteForbidden:
                 return False
             except Exception as e:
@@ -73,10 +76,11 @@ def download_media(client: Client, file_id: str, file_path: str) -> Optional[str
         while flood_wait:
             flood_wait = False
             try:
+                wait_token("get")
                 result = client.download_media(message=file_id, file_name=file_path)
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "get")
     except Exception as e:
         logger.warning(f"Download media {file_id} to {file_path} error: {e}", exc_info=True)
 
@@ -109,6 +113,7 @@ def forward_messages(client: Client, cid: int, fid: int,
     result = None
 
     try:
+        wait_token("send", cid)
         result = client.forward_messages(
             chat_id=cid,
             from_chat_id=fid,
@@ -117,6 +122,7 @@ def forward_messages(client: Client, cid: int, fid: int,
         )
     except FloodWait as e:
         logger.warning(f"Forward message from {fid} to {cid} - Sleep for {e.x} second(s)")
+        wait_flood(e, "send", cid)
         raise e
     except (ChannelInvalid, ChannelPrivate, ChatAdminRequired, MessageIdInvalid, PeerIdInvalid):
         return False
@@ -134,6 +140,7 @@ def copy_message(client: Client, cid: int, fid: int, mid: int) -> Union[bool, Me
     result = None
 
     try:
+        wait_token("send", cid)
         result = client.copy_message(
             chat_id=cid,
             from_chat_id=fid,
@@ -142,6 +149,7 @@ def copy_message(client: Client, cid: int, fid: int, mid: int) -> Union[bool, Me
         )
     except FloodWait as e:
         logger.warning(f"Forward message from {fid} to {cid} - Sleep for {e.x} second(s)")
+        wait_flood(e, "send", cid)
         raise e
     except (ChannelInvalid, ChannelPrivate, ChatAdminRequired, MessageIdInvalid, PeerIdInvalid):
         return False
@@ -159,10 +167,11 @@ def get_admins(client: Client, cid: int) -> Union[bool, List[ChatMember], None]:
         while flood_wait:
             flood_wait = False
             try:
+                wait_token("get")
                 result = client.get_chat_members(chat_id=cid, filter="administrators")
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "get")
             except (ChannelInvalid, ChannelPrivate, PeerIdInvalid):
                 return False
     except Exception as e:
@@ -177,8 +186,10 @@ def get_chat(client: Client, cid: Union[int, str]) -> Union[Chat, ChatPreview, N
     result = None
 
     try:
+        wait_token("get")
         result = client.get_chat(chat_id=cid)
     except FloodWait as e:
+        wait_flood(e, "get")
         raise e
     except (ChannelInvalid, ChannelPrivate, PeerIdInvalid):
         return None
@@ -196,10 +207,11 @@ def get_chat_member(client: Client, cid: int, uid: int) -> Union[bool, ChatMembe
         while flood_wait:
             flood_wait = False
             try:
+                wait_token("get")
                 result = client.get_chat_member(chat_id=cid, user_id=uid)
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "get")
             except (PeerIdInvalid, UserNotParticipant):
                 result = False
     except Exception as e:
@@ -214,17 +226,8 @@ def get_group_info(client: Client, chat: Union[int, Chat], cache: bool = True) -
     group_link = glovar.default_group_link
     try:
         if isinstance(chat, int):
-            the_cache = glovar.chats.get(chat)
-
-            if the_cache:
-                chat = the_cache
-            else:
-                result = get_chat(client, chat)
-
-                if cache and result:
-                    glovar.chats[chat] = result
-
-                chat = result
+            cid = chat
+            chat = get_cache("chats", cid, partial(get_chat, client, cid), cache)
 
         if not chat:
             return group_name, group_link
@@ -248,10 +251,11 @@ def get_messages(client: Client, cid: int, mids: Union[int, Iterable[int]]) -> U
         while flood_wait:
             flood_wait = False
             try:
+                wait_token("get")
                 result = client.get_messages(chat_id=cid, message_ids=mids)
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "get")
             except PeerIdInvalid:
                 return None
     except Exception as e:
@@ -260,16 +264,10 @@ def get_messages(client: Client, cid: int, mids: Union[int, Iterable[int]]) -> U
     return result
 
 
-def get_sticker_title(client: Client, short_name: str, normal: bool = False, printable: bool = True,
-                      cache: bool = True) -> Optional[str]:
-    # Get sticker set's title
+def get_sticker_set_title(client: Client, short_name: str, normal: bool, printable: bool) -> Optional[str]:
+    # Get sticker set's title from Telegram
     result = None
     try:
-        result = glovar.sticker_titles.get(short_name)
-
-        if result and cache:
-            return glovar.sticker_titles[short_name]
-
         sticker_set = InputStickerSetShortName(short_name=short_name)
 
         flood_wait = True
@@ -287,9 +285,20 @@ def get_sticker_title(client: Client, short_name: str, normal: bool = False, pri
                         result = t2t(inner_set.title, normal, printable)
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "get")
+    except Exception as e:
+        logger.warning(f"Get sticker set {short_name} title error: {e}", exc_info=True)
+
+    return result
+
 
-        glovar.sticker_titles[short_name] = result
+def get_sticker_title(client: Client, short_name: str, normal: bool = False, printable: bool = True,
+                      cache: bool = True) -> Optional[str]:
+    # Get sticker set's title
+    result = None
+    try:
+        result = get_cache("sticker_titles", short_name,
+                           partial(get_sticker_set_title, client, short_name, normal, printable), cache)
     except Exception as e:
         logger.warning(f"Get sticker {short_name} title error: {e}", exc_info=True)
 
@@ -307,6 +316,7 @@ def get_user_full(client: Client, uid: int) -> Optional[UserFull]:
         if not user_id:
             return None
 
+        wait_token("get")
         result = client.send(GetFullUser(id=user_id))
 
         # TODO
@@ -319,6 +329,7 @@ def get_user_full(client: Client, uid: int) -> Optional[UserFull]:
             return None
 
     except FloodWait as e:
+        wait_flood(e, "get")
         raise e
     except Exception as e:
         logger.warning(f"Get user {uid} full error: {e}", exc_info=True)
@@ -326,6 +337,33 @@ def get_user_full(client: Client, uid: int) -> Optional[UserFull]:
     return result
 
 
+def get_username_peer(client: Client, username: str) -> Optional[Dict[str, Union[int, str]]]:
+    # Get the peer type and ID of a username from Telegram, return None if the username can not be resolved now
+    result = None
+    try:
+        peer = resolve_peer(client, username)
+
+        if peer is None:
+            return None
+
+        result = {}
+
+        if isinstance(peer, InputPeerChannel):
+            result = {
+                "peer_type": "channel",
+                "peer_id": get_int(f"-100{peer.channel_id}")
+            }
+        elif isinstance(peer, InputPeerUser):
+            result = {
+                "peer_type": "user",
+                "peer_id": peer.user_id
+            }
+    except Exception as e:
+        logger.warning(f"Get username {username} peer error: {e}", exc_info=True)
+
+    return result
+
+
 def get_users(client: Client, uids: Iterable[Union[int, str]]) -> Optional[List[User]]:
     # Get users
     result = None
@@ -334,10 +372,11 @@ def get_users(client: Client, uids: Iterable[Union[int, str]]) -> Optional[List[
         while flood_wait:
             flood_wait = False
             try:
+                wait_token("get")
                 result = client.get_users(user_ids=uids)
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "get")
             except PeerIdInvalid:
                 return None
     except Exception as e:
@@ -354,10 +393,11 @@ def kick_chat_member(client: Client, cid: int, uid: Union[int, str]) -> Union[bo
         while flood_wait:
             flood_wait = False
             try:
+                wait_token("ban")
                 result = client.kick_chat_member(chat_id=cid, user_id=uid)
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "ban")
     except Exception as e:
         logger.warning(f"Kick chat member {uid} in {cid} error: {e}", exc_info=True)
 
@@ -371,10 +411,11 @@ def leave_chat(client: Client, cid: int, delete: bool = False) -> bool:
         while flood_wait:
             flood_wait = False
             try:
+                wait_token("get")
                 client.leave_chat(chat_id=cid, delete=delete)
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "get")
             except (ChannelInvalid, ChannelPrivate, PeerIdInvalid):
                 return False
 
@@ -393,10 +434,11 @@ def resolve_peer(client: Client, pid: Union[int, str]) -> Union[bool, InputChann
         while flood_wait:
             flood_wait = False
             try:
+                wait_token("get")
                 result = client.resolve_peer(pid)
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "get")
             except (PeerIdInvalid, UsernameInvalid, UsernameNotOccupied):
                 return False
     except Exception as e:
@@ -415,26 +457,11 @@ def resolve_username(client: Client, username: str, cache: bool = True) -> (str,
         if not username:
             return "", 0
 
-        result = glovar.usernames.get(username)
-
-        if result and cache:
-            return result["peer_type"], result["peer_id"]
-
-        result = resolve_peer(client, username)
+        result = get_cache("usernames", username, partial(get_username_peer, client, username), cache)
 
         if result:
-            if isinstance(result, InputPeerChannel):
-                peer_type = "channel"
-                peer_id = result.channel_id
-                peer_id = get_int(f"-100{peer_id}")
-            elif isinstance(result, InputPeerUser):
-                peer_type = "user"
-                peer_id = result.user_id
-
-        glovar.usernames[username] = {
-            "peer_type": peer_type,
-            "peer_id": peer_id
-        }
+            peer_type = result["peer_type"]
+            peer_id = result["peer_id"]
     except Exception as e:
         logger.warning(f"Resolve username {username} error: {e}", exc_info=True)
 
@@ -450,6 +477,7 @@ def restrict_chat_member(client: Client, cid: int, uid: int, permissions: ChatPe
         while flood_wait:
             flood_wait = False
             try:
+                wait_token("ban")
                 result = client.restrict_chat_member(
                     chat_id=cid,
                     user_id=uid,
@@ -458,7 +486,7 @@ def restrict_chat_member(client: Client, cid: int, uid: int, permissions: ChatPe
                 )
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "ban")
     except Exception as e:
         logger.warning(f"Restrict chat member {uid} in {cid} error: {e}", exc_info=True)
 
@@ -474,6 +502,7 @@ def send_document(client: Client, cid: int, document: str, caption: str = "", mi
         while flood_wait:
             flood_wait = False
             try:
+                wait_token("send", cid)
                 result = client.send_document(
                     chat_id=cid,
                     document=document,
@@ -484,7 +513,7 @@ def send_document(client: Client, cid: int, document: str, caption: str = "", mi
                 )
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "send", cid)
             except ButtonDataInvalid:
                 logger.warning(f"Send document {document} to {cid} - invalid markup: {markup}")
             except (ChannelInvalid, ChannelPrivate, ChatAdminRequired, PeerIdInvalid):
@@ -507,6 +536,7 @@ def send_message(client: Client, cid: int, text: str, mid: int = None,
         while flood_wait:
             flood_wait = False
             try:
+                wait_token("send", cid)
                 result = client.send_message(
                     chat_id=cid,
                     text=text,
@@ -517,7 +547,7 @@ def send_message(client: Client, cid: int, text: str, mid: int = None,
                 )
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "send", cid)
             except ButtonDataInvalid:
                 logger.warning(f"Send message to {cid} - invalid markup: {markup}")
             except (ChannelInvalid, ChannelPrivate, ChatAdminRequired, PeerIdInvalid):
@@ -540,6 +570,7 @@ def send_photo(client: Client, cid: int, photo: str, caption: str = "", mid: int
         while flood_wait:
             flood_wait = False
             try:
+                wait_token("send", cid)
                 result = client.send_photo(
                     chat_id=cid,
                     photo=photo,
@@ -550,7 +581,7 @@ def send_photo(client: Client, cid: int, photo: str, caption: str = "", mid: int
                 )
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "send", cid)
             except ButtonDataInvalid:
                 logger.warning(f"Send photo {photo} to {cid} - invalid markup: {markup}")
             except (ChannelInvalid, ChannelPrivate, ChatAdminRequired, PeerIdInvalid):
@@ -573,6 +604,7 @@ def send_report_message(secs: int, client: Client, cid: int, text: str, mid: int
         while flood_wait:
             flood_wait = False
             try:
+                wait_token("send", cid)
                 result = client.send_message(
                     chat_id=cid,
                     text=text,
@@ -583,7 +615,7 @@ def send_report_message(secs: int, client: Client, cid: int, text: str, mid: int
                 )
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "send", cid)
             except ButtonDataInvalid:
                 logger.warning(f"Send report message to {cid} - invalid markup: {markup}")
             except (ChannelInvalid, ChannelPrivate, ChatAdminRequired, PeerIdInvalid):
@@ -23,11 +23,12 @@ from pyrogram import Client
 from pyrogram.types import Message
 
 from .. import glovar
-from .channel import get_content
-from .etc import code, get_int, get_md5sum, get_text, italic, lang, mention_id, thread
-from .file import delete_file, get_downloaded_path
-from .filters import is_class_e, is_detected_url, is_regex_text
-from .image import get_file_id, get_ocr, get_qrcode
+from .channel import get_content, get_content_cache
+from .etc import code, get_int, get_text, italic, lang, mention_id, thread
+from .file import delete_file
+from .filters import get_regex_hits, is_class_e, is_detected_url
+from .image import get_image, get_image_value
+from .regex import get_contacts_found
 from .telegram import send_message
 
 # Enable logging
@@ -51,7 +52,7 @@ def nospam_test(client: Client, message: Message) -> bool:
 
         # Detected record
         content = get_content(message)
-        detection = glovar.contents.get(content, "")
+        detection = get_content_cache(content)
 
         if detection:
             text += f"{lang('record_content')}{lang('colon')}{code(lang(detection.split()[0]))}\n"
@@ -67,19 +68,15 @@ def nospam_test(client: Client, message: Message) -> bool:
             text += f"{lang('record_bad')}{lang('colon')}{code('True')}\n"
 
         # Recorded contact
-        for contact in glovar.bad_ids["contacts"]:
-            if not re.search(contact, message_text, re.I):
-                continue
-
+        for contact in get_contacts_found(message_text):
             text += f"{lang('record_contact')}{lang('colon')}{code(contact)}\n"
 
         # Image
-        file_id, big = get_file_id(message)
-        image_path = big and get_downloaded_path(client, file_id)
-        image_hash = image_path and get_md5sum("file", image_path)
-        qrcode = image_path and get_qrcode(image_path)
-        ocr = image_path and get_ocr(image_path, True)
-        image_path and thread(delete_file, (image_path,))
+        image = get_image(client, message, False)
+        image_hash = image["hash"]
+        qrcode = get_image_value(client, image, "qrcode")
+        ocr = get_image_value(client, image, "ocr_test")
+        image["path"] and thread(delete_file, (image["path"],), pool="file")
 
         # OCR
         text = nospam_test_ocr(text, ocr, message_text)
@@ -118,7 +115,8 @@ def nospam_test_ocr(text: str, ocr: str, message_text: str) -> str:
         result += f"\n{lang('ocr_result')}{lang('colon')}" + "-" * 24 + "\n\n"
         result += code(ocr) + "\n\n"
 
-        type_list = [lang(t) for t in glovar.regex if is_regex_text(t, ocr, True)]
+        hits = get_regex_hits(ocr, True, glovar.regex)
+        type_list = [lang(t) for t in glovar.regex if hits.get(t)]
 
         if type_list:
             result += f"{lang('ocr')}{lang('colon')}" + "-" * 24 + "\n\n"
@@ -130,7 +128,8 @@ def nospam_test_ocr(text: str, ocr: str, message_text: str) -> str:
 
         all_text = message_text + ocr
 
-        type_list = [lang(t) for t in glovar.regex if is_regex_text(t, all_text)]
+        hits = get_regex_hits(all_text, False, glovar.regex)
+        type_list = [lang(t) for t in glovar.regex if hits.get(t)]
 
         if not type_list:
             return result
@@ -154,7 +153,8 @@ def nospam_test_qrcode(text: str, qrcode: str) -> str:
         text += f"\n{lang('qrcode')}{lang('colon')}" + "-" * 24 + "\n\n"
         text += code(qrcode) + "\n\n"
 
-        type_list = [lang(t) for t in glovar.regex if is_regex_text(t, qrcode)]
+        hits = get_regex_hits(qrcode, False, glovar.regex)
+        type_list = [lang(t) for t in glovar.regex if hits.get(t)]
 
         if not type_list:
             return result
@@ -17,18 +17,21 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from copy import deepcopy
 from time import sleep
+from typing import Dict
 
 from pyrogram import Client
+from pyrogram.types import User
 
 from .. import glovar
 from .channel import ask_for_help, get_debug_text, share_data, share_regex_count
-from .etc import code, general_link, get_full_name, get_now, lang, message_link, t2t, thread
-from .file import data_to_file, save
+from .etc import code, general_link, get_full_name, get_now, get_user_lock, lang, lock_users, message_link, t2t, thread
+from .file import data_to_file, save, save_files
 from .filters import is_nm_text
 from .group import leave_group
-from .telegram import get_admins, get_group_info, send_message
+from .ids import build_expiry, get_new_users, prune_expiry, update_trust_ids
+from .regex import flush_counts
+from .telegram import get_admins, get_group_info, get_users, send_message
 from .user import add_bad_user, ban_user, get_user
 
 # Enable logging
@@ -38,6 +41,9 @@ logger = logging.getLogger(__name__)
 def backup_files(client: Client) -> bool:
     # Backup data files to BACKUP
     try:
+        # Write the changed data first, the journals should be compacted into the shared files
+        save_files(True)
+
         for file in glovar.file_list:
             # Check
             if not eval(f"glovar.{file}"):
@@ -89,42 +95,120 @@ def interval_hour_01(client: Client) -> bool:
 
 def interval_min_10() -> bool:
     # Execute every 10 minutes
-    glovar.locks["message"].acquire()
     try:
-        # Clear recorded users
-        for gid in list(glovar.recorded_ids):
-            glovar.recorded_ids[gid] = set()
+        # Remove expired watch users
+        prune_expiry(get_now())
+
+        # Save regex hit counts
+        flush_counts()
 
         return True
     except Exception as e:
         logger.warning(f"Interval min 10 error: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
 
     return False
 
 
-def interval_min_15(client: Client) -> bool:
+def interval_min_15() -> bool:
     # Execute every 15 minutes
     try:
-        # Check user's name
+        # Queue the new joined users for the nick recheck, the users left by the last round are checked first
         now = get_now()
 
-        with glovar.locks["message"] and glovar.locks["text"]:
-            user_ids = deepcopy(glovar.user_ids)
+        with glovar.locks["recheck"]:
+            queue = glovar.recheck["queue"]
+            lag = len(queue)
+            queued = set(queue)
+            queue.extend(uid for uid in get_new_users(now) if uid not in queued)
+            ticks = 15 * 60 // glovar.recheck["interval"]
+            glovar.recheck["batch"] = -(-len(queue) // ticks)
+            glovar.recheck["done"] = 0
+            glovar.recheck["lag"] = lag
+            glovar.recheck["total"] = len(queue)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Interval min 15 error: {e}", exc_info=True)
+
+    return False
+
+
+def recheck_nick(client: Client, user: User, join: Dict[int, int]) -> bool:
+    # Recheck a new joined user's name
+    try:
+        uid = user.id
+        g_list = [gid for gid in join if glovar.configs.get(gid)]
+
+        # Get name
+        name = get_full_name(user)
+
+        if not name or name in glovar.except_ids["long"]:
+            return True
+
+        # Check name
+        t2t_name = t2t(name, True, True)
+
+        if not is_nm_text(t2t_name):
+            return True
+
+        text = (f"{lang('project')}{lang('colon')}{code(glovar.sender)}\n"
+                f"{lang('user_id')}{lang('colon')}{code(uid)}\n"
+                f"{lang('level')}{lang('colon')}{code(lang('auto_ban'))}\n"
+                f"{lang('rule')}{lang('colon')}{code(lang('nick_recheck'))}\n"
+                f"{lang('message_type')}{lang('colon')}{code(lang('ser'))}\n"
+                f"{lang('user_name')}{lang('colon')}{code(name)}\n")
+        result = send_message(client, glovar.logging_channel_id, text)
+
+        if not result:
+            return True
+
+        gid = sorted(g_list, key=lambda g: join[g], reverse=True)[0]
+
+        for the_id in g_list:
+            if (glovar.configs[the_id].get("nick")
+                    and not glovar.configs[gid].get("deleter")
+                    and not glovar.configs[gid].get("reporter")):
+                gid = the_id
+                break
+
+        add_bad_user(client, uid)
+        ban_user(client, gid, uid)
+        ask_for_help(client, "ban", gid, uid)
+        text = get_debug_text(client, gid)
+        text += (f"{lang('user_id')}{lang('colon')}{code(uid)}\n"
+                 f"{lang('action')}{lang('colon')}{code(lang('name_ban'))}\n"
+                 f"{lang('evidence')}{lang('colon')}{general_link(result.message_id, message_link(result))}\n")
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="log")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Recheck nick error: {e}", exc_info=True)
+
+    return False
+
+
+def recheck_users(client: Client) -> bool:
+    # Recheck a batch of the queued users, the queue of each round is spread over the interval
+    try:
+        with glovar.locks["recheck"]:
+            queue = glovar.recheck["queue"]
+            uids = [queue.popleft() for _ in range(min(glovar.recheck["batch"], len(queue)))]
+
+        if not uids:
+            return True
+
+        # Check the config
+        joins = {}
 
-        for uid in user_ids:
+        for uid in uids:
             # Do not check banned users
             if uid in glovar.bad_ids["users"]:
                 continue
 
-            # Check new joined users
-            if not any(now - user_ids[uid]["join"][gid] < glovar.time_new for gid in user_ids[uid]["join"]):
-                continue
+            with get_user_lock(uid):
+                join = dict(glovar.user_ids.get(uid, {}).get("join", {}))
 
-            # Check the config
-            group_list = list(user_ids[uid]["join"])
-            g_list = [gid for gid in group_list if glovar.configs.get(gid)]
+            g_list = [gid for gid in join if glovar.configs.get(gid)]
 
             if all((not glovar.configs[gid].get("nick")
                     or glovar.configs[gid].get("deleter")
@@ -132,56 +216,27 @@ def interval_min_15(client: Client) -> bool:
                    for gid in g_list):
                 continue
 
-            # Get user
-            user = get_user(client, uid)
-
-            if not user:
-                continue
-
-            # Get name
-            name = get_full_name(user)
-
-            if not name or name in glovar.except_ids["long"]:
-                continue
-
-            # Check name
-            t2t_name = t2t(name, True, True)
-
-            if not is_nm_text(t2t_name):
-                continue
+            joins[uid] = join
 
-            text = (f"{lang('project')}{lang('colon')}{code(glovar.sender)}\n"
-                    f"{lang('user_id')}{lang('colon')}{code(uid)}\n"
-                    f"{lang('level')}{lang('colon')}{code(lang('auto_ban'))}\n"
-                    f"{lang('rule')}{lang('colon')}{code(lang('nick_recheck'))}\n"
-                    f"{lang('message_type')}{lang('colon')}{code(lang('ser'))}\n"
-                    f"{lang('user_name')}{lang('colon')}{code(name)}\n")
-            result = send_message(client, glovar.logging_channel_id, text)
+        # Get users in batches, an invalid user fails the whole batch, so the batch is retried one by one
+        uid_list = list(joins)
 
-            if not result:
-                continue
+        for i in range(0, len(uid_list), 200):
+            batch = uid_list[i:i + 200]
+            users = get_users(client, batch)
 
-            gid = sorted(g_list, key=lambda g: user_ids[uid]["join"][g], reverse=True)[0]
+            if users is None and len(batch) > 1:
+                users = [get_user(client, uid) for uid in batch]
 
-            for the_id in g_list:
-                if (glovar.configs[the_id].get("nick")
-                        and not glovar.configs[gid].get("deleter")
-                        and not glovar.configs[gid].get("reporter")):
-                    gid = the_id
-                    break
+            for user in [user for user in users or [] if user and user.id in joins]:
+                recheck_nick(client, user, joins[user.id])
 
-            add_bad_user(client, uid)
-            ban_user(client, gid, uid)
-            ask_for_help(client, "ban", gid, uid)
-            text = get_debug_text(client, gid)
-            text += (f"{lang('user_id')}{lang('colon')}{code(uid)}\n"
-                     f"{lang('action')}{lang('colon')}{code(lang('name_ban'))}\n"
-                     f"{lang('evidence')}{lang('colon')}{general_link(result.message_id, message_link(result))}\n")
-            thread(send_message, (client, glovar.debug_channel_id, text))
+        with glovar.locks["recheck"]:
+            glovar.recheck["done"] += len(uids)
 
         return True
     except Exception as e:
-        logger.warning(f"Interval min 15 error: {e}", exc_info=True)
+        logger.warning(f"Recheck users error: {e}", exc_info=True)
 
     return False
 
@@ -189,27 +244,31 @@ def interval_min_15(client: Client) -> bool:
 def reset_data(client: Client) -> bool:
     # Reset user data every month
     try:
-        glovar.bad_ids["contacts"] = set()
-        glovar.bad_ids["contents"] = set()
-        glovar.bad_ids["users"] = set()
-        save("bad_ids")
-
-        glovar.except_ids["temp"] = set()
-        save("except_ids")
-
-        glovar.user_ids = {}
-        save("user_ids")
+        # Stop the message checks while the data is reset
+        with lock_users():
+            glovar.bad_ids["contacts"] = set()
+            glovar.bad_ids["contents"] = set()
+            glovar.bad_ids["users"] = set()
+            save("bad_ids")
+
+            glovar.except_ids["temp"] = set()
+            save("except_ids")
+
+            glovar.user_ids = {}
+            save("user_ids")
+
+            glovar.watch_ids = {
+                "ban": {},
+                "delete": {}
+            }
+            save("watch_ids")
 
-        glovar.watch_ids = {
-            "ban": {},
-            "delete": {}
-        }
-        save("watch_ids")
+        build_expiry()
 
         # Send debug message
         text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
                 f"{lang('action')}{lang('colon')}{code(lang('reset'))}\n")
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="log")
 
         return True
     except Exception as e:
@@ -220,22 +279,21 @@ def reset_data(client: Client) -> bool:
 
 def send_count(client: Client) -> bool:
     # Send regex count to REGEX
-    glovar.locks["regex"].acquire()
     try:
-        for word_type in glovar.regex:
-            share_regex_count(client, word_type)
-            word_list = list(eval(f"glovar.{word_type}_words"))
+        # Take the counts and start counting again
+        with glovar.locks["count"]:
+            counts = glovar.counts
+            glovar.counts = {word_type: {} for word_type in glovar.regex}
+            glovar.counts_changed = True
 
-            for word in word_list:
-                eval(f"glovar.{word_type}_words")[word] = 0
+        for word_type in glovar.regex:
+            share_regex_count(client, word_type, counts.get(word_type, {}))
 
-            save(f"{word_type}_words")
+        flush_counts()
 
         return True
     except Exception as e:
         logger.warning(f"Send count error: {e}", exc_info=True)
-    finally:
-        glovar.locks["regex"].release()
 
     return False
 
@@ -262,10 +320,9 @@ def update_admins(client: Client) -> bool:
                 save("admin_ids")
 
                 # Trust list
-                glovar.trust_ids[gid] = {admin.user.id for admin in admin_members
-                                         if ((not admin.user.is_bot and not admin.user.is_deleted)
-                                             or admin.user.id in glovar.bot_ids)}
-                save("trust_ids")
+                update_trust_ids(gid, {admin.user.id for admin in admin_members
+                                       if ((not admin.user.is_bot and not admin.user.is_deleted)
+                                           or admin.user.id in glovar.bot_ids)})
 
                 if glovar.user_id not in glovar.admin_ids[gid]:
                     reason = "user"
@@ -306,7 +363,7 @@ def update_admins(client: Client) -> bool:
                               f"{lang('group_name')}{lang('colon')}{general_link(group_name, group_link)}\n"
                               f"{lang('group_id')}{lang('colon')}{code(gid)}\n"
                               f"{lang('status')}{lang('colon')}{code(reason)}\n")
-                thread(send_message, (client, glovar.debug_channel_id, debug_text))
+                thread(send_message, (client, glovar.debug_channel_id, debug_text), pool="log")
             elif admin_members is False or any([admin.user.is_self for admin in admin_members]) is False:
                 # Bot is not in the chat, leave automatically without approve
                 group_name, group_link = get_group_info(client, gid)
@@ -328,7 +385,7 @@ def update_admins(client: Client) -> bool:
                               f"{lang('group_id')}{lang('colon')}{code(gid)}\n"
                               f"{lang('status')}{lang('colon')}{code(lang('leave_auto'))}\n"
                               f"{lang('reason')}{lang('colon')}{code(lang('reason_leave'))}\n")
-                thread(send_message, (client, glovar.debug_channel_id, debug_text))
+                thread(send_message, (client, glovar.debug_channel_id, debug_text), pool="log")
 
         return True
     except Exception as e:
@@ -32,7 +32,8 @@ from .file import save
 from .group import delete_message
 from .filters import is_class_d, is_declared_message, is_detected_user, is_friend_username, is_high_score_user
 from .filters import is_limited_user, is_old_user, is_regex_text
-from .ids import init_user_id
+from .ids import add_window_id, init_user_id, is_window_id
+from .regex import get_compiled
 from .telegram import get_users, kick_chat_member, restrict_chat_member, send_message
 
 # Enable logging
@@ -98,11 +99,13 @@ def get_contacts(text: str) -> Set[str]:
             if not match:
                 continue
 
-            for regex in eval(f"glovar.{the_type}_words"):
-                if "?P<con>" not in regex:
+            compiled = get_compiled(the_type)
+
+            for word, pattern in zip(compiled.get("words", []), compiled.get("patterns", [])):
+                if not pattern or "?P<con>" not in word:
                     continue
 
-                sub_match = re.search(regex, text, re.I | re.M | re.S)
+                sub_match = pattern.search(text)
 
                 if not sub_match:
                     continue
@@ -174,7 +177,7 @@ def global_delete_score(client: Client, uid: int) -> bool:
                 f"{lang('user_id')}{lang('colon')}{code(uid)}\n"
                 f"{lang('action')}{lang('colon')}{code(lang('global_delete'))}\n"
                 f"{lang('evidence')}{lang('colon')}{general_link(result.message_id, message_link(result))}\n")
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="log")
 
         return True
     except Exception as e:
@@ -211,7 +214,7 @@ def global_delete_watch(client: Client, uid: int, mid: int) -> bool:
                 f"{lang('action')}{lang('colon')}{code(lang('global_delete'))}\n"
                 f"{lang('triggered_by')}{lang('colon')}{general_link(mid, triggered_link)}\n"
                 f"{lang('evidence')}{lang('colon')}{general_link(result.message_id, message_link(result))}\n")
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="log")
 
         return True
     except Exception as e:
@@ -235,6 +238,7 @@ def record_contacts_info(client: Client, text: str) -> Set[str]:
                     and contact not in glovar.bad_ids["contacts"]
                     and is_friend_username(client, gid, contact, True)) is not True:
                 glovar.bad_ids["contacts"].add(contact)
+                glovar.contact_matcher = {}
                 save("bad_ids")
 
         result = contacts
@@ -277,6 +281,7 @@ def remove_contacts_info(message: Message, text: str) -> bool:
         for contact in contacts:
             if contact and contact in glovar.bad_ids["contacts"]:
                 glovar.bad_ids["contacts"].discard(contact)
+                glovar.contact_matcher = {}
                 save("bad_ids")
     except Exception as e:
         logger.warning(f"Remove contacts info error: {e}", exc_info=True)
@@ -354,7 +359,7 @@ def terminate_user(client: Client, message: Message, user: User, context: str) -
 
             # Check if necessary
             if (not glovar.configs[gid].get("scorer")
-                    or (uid in glovar.recorded_ids[gid] and is_high_score_user(message.from_user))):
+                    or (is_window_id("recorded_ids", gid, uid) and is_high_score_user(message.from_user))):
                 return True
 
             # Terminate
@@ -372,7 +377,7 @@ def terminate_user(client: Client, message: Message, user: User, context: str) -
                 glovar.user_ids[uid]["bad"][gid] = glovar.user_ids[uid]["bad"].get(gid, 0) + 1
                 update_score(client, uid)
                 auto_report(client, message)
-                glovar.recorded_ids[gid].add(uid)
+                add_window_id("recorded_ids", gid, uid)
                 send_debug(
                     client=client,
                     chat=message.chat,
@@ -393,7 +398,7 @@ def terminate_user(client: Client, message: Message, user: User, context: str) -
                 more = lang("reporter")
 
             # Check if necessary
-            if uid in glovar.recorded_ids[gid] and is_high_score_user(message.from_user):
+            if is_window_id("recorded_ids", gid, uid) and is_high_score_user(message.from_user):
                 return True
 
             # Terminate
@@ -411,7 +416,7 @@ def terminate_user(client: Client, message: Message, user: User, context: str) -
                 glovar.user_ids[uid]["bad"][gid] = glovar.user_ids[uid]["bad"].get(gid, 0) + 1
                 update_score(client, uid)
                 auto_report(client, message)
-                glovar.recorded_ids[gid].add(uid)
+                add_window_id("recorded_ids", gid, uid)
                 send_debug(
                     client=client,
                     chat=message.chat,
@@ -433,7 +438,7 @@ def terminate_user(client: Client, message: Message, user: User, context: str) -
                 more = lang("white_user")
 
             # Check if necessary
-            if uid in glovar.recorded_ids[gid]:
+            if is_window_id("recorded_ids", gid, uid):
                 return True
 
             # Terminate
@@ -450,7 +455,7 @@ def terminate_user(client: Client, message: Message, user: User, context: str) -
             if result:
                 glovar.user_ids[uid]["bad"][gid] = glovar.user_ids[uid]["bad"].get(gid, 0) + 1
                 update_score(client, uid)
-                glovar.recorded_ids[gid].add(uid)
+                add_window_id("recorded_ids", gid, uid)
                 send_debug(
                     client=client,
                     chat=message.chat,
@@ -478,7 +483,7 @@ def terminate_user(client: Client, message: Message, user: User, context: str) -
                 more = ""
 
             # Terminate
-            if is_detected_user(message) or uid in glovar.recorded_ids[gid] or level == "true":
+            if is_detected_user(message) or is_window_id("recorded_ids", gid, uid) or level == "true":
                 delete_message(client, gid, mid)
                 add_detected_user(gid, uid, now)
                 declare_message(client, gid, mid)
@@ -494,7 +499,7 @@ def terminate_user(client: Client, message: Message, user: User, context: str) -
                 )
 
                 if result:
-                    glovar.recorded_ids[gid].add(uid)
+                    add_window_id("recorded_ids", gid, uid)
                     delete_message(client, gid, mid)
                     declare_message(client, gid, mid)
                     previous = add_detected_user(gid, uid, now)
@@ -527,7 +532,7 @@ def terminate_user(client: Client, message: Message, user: User, context: str) -
                 general = False
 
             # Terminate
-            if is_detected_user(message) or uid in glovar.recorded_ids[gid]:
+            if is_detected_user(message) or is_window_id("recorded_ids", gid, uid):
                 delete_message(client, gid, mid)
                 add_detected_user(gid, uid, now)
                 declare_message(client, gid, mid)
@@ -544,7 +549,7 @@ def terminate_user(client: Client, message: Message, user: User, context: str) -
                 )
 
                 if result:
-                    glovar.recorded_ids[gid].add(uid)
+                    add_window_id("recorded_ids", gid, uid)
                     delete_message(client, gid, mid)
                     declare_message(client, gid, mid)
                     previous = add_detected_user(gid, uid, now)
@@ -576,7 +581,7 @@ def terminate_user(client: Client, message: Message, user: User, context: str) -
                 debug_action = lang("score_micro")
 
                 # Check if necessary
-                if uid in glovar.recorded_ids[gid] and is_high_score_user(message.from_user):
+                if is_window_id("recorded_ids", gid, uid) and is_high_score_user(message.from_user):
                     return True
 
                 # Terminate
@@ -592,8 +597,8 @@ def terminate_user(client: Client, message: Message, user: User, context: str) -
                 if result:
                     glovar.user_ids[uid]["bad"][gid] = glovar.user_ids[uid]["bad"].get(gid, 0) + 1
                     update_score(client, uid)
-                    uid not in glovar.recorded_ids[gid] and auto_report(client, message)
-                    glovar.recorded_ids[gid].add(uid)
+                    not is_window_id("recorded_ids", gid, uid) and auto_report(client, message)
+                    add_window_id("recorded_ids", gid, uid)
                     send_debug(
                         client=client,
                         chat=message.chat,
@@ -603,7 +608,7 @@ def terminate_user(client: Client, message: Message, user: User, context: str) -
                         em=result
                     )
             else:
-                if is_detected_user(message) or uid in glovar.recorded_ids[gid]:
+                if is_detected_user(message) or is_window_id("recorded_ids", gid, uid):
                     delete_message(client, gid, mid)
                     add_detected_user(gid, uid, now)
                     declare_message(client, gid, mid)
@@ -618,7 +623,7 @@ def terminate_user(client: Client, message: Message, user: User, context: str) -
                     )
 
                     if result:
-                        glovar.recorded_ids[gid].add(uid)
+                        add_window_id("recorded_ids", gid, uid)
                         delete_message(client, gid, mid)
                         declare_message(client, gid, mid)
                         previous = add_detected_user(gid, uid, now)
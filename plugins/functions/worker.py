@@ -0,0 +1,105 @@
+# SCP-079-NOSPAM - Block spam in groups
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-NOSPAM.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from typing import List
+
+from PIL import Image, ImageChops, ImageEnhance
+
+# Functions in this module run in the worker processes, so they should not use the global variables,
+# the errors are raised to the caller
+# The OCR and QR code libraries are imported by the workers only, the fork server preloads them
+
+
+def get_color(path: str) -> bool:
+    # Get the picture's color, check if most of it is yellow
+    image = Image.open(path).convert("RGB")
+    image.thumbnail((512, 512))
+    image = image.convert("YCbCr")
+    w, h = image.size
+    _, cb, cr = image.split()
+
+    # Mark the pixels in the yellow range with 255, then count them in the histogram
+    cb = cb.point(get_range_table(86, 117))
+    cr = cr.point(get_range_table(140, 168))
+    cnt = ImageChops.multiply(cb, cr).histogram()[255]
+
+    return cnt > w * h * 0.3
+
+
+def get_ocr(path: str) -> str:
+    # Get the text in the picture
+    from pytesseract import image_to_string
+
+    image = Image.open(path)
+    enhancer = ImageEnhance.Contrast(image)
+    image = enhancer.enhance(2)
+    result = image_to_string(image, lang='chi_sim+chi_tra')
+
+    if not result:
+        image = image.convert('L')
+        image = get_processed_image(image)
+        result = image_to_string(image, lang='chi_sim+chi_tra')
+
+    return result
+
+
+def get_processed_image(image: Image.Image) -> Image.Image:
+    # Get the binarized image
+    image.thumbnail((200, 200))
+    histogram = image.histogram()
+    aver = int(sum(color * count for color, count in enumerate(histogram)) / sum(histogram))
+
+    if aver < 110:
+        image = image.point(get_range_table(0, aver + 20))
+    else:
+        image = image.point(get_range_table(aver - 20, 255))
+
+    return image
+
+
+def get_qrcode(path: str) -> str:
+    # Get QR code
+    from pyzbar.pyzbar import decode
+
+    result = ""
+
+    # Open
+    image = Image.open(path)
+
+    # Gray
+    image = image.convert("L")
+
+    # Contrast
+    image = ImageEnhance.Contrast(image).enhance(4.0)
+
+    # Thresholding
+    image = image.point(get_range_table(150, 255))
+
+    # Decode
+    decoded_list = decode(image)
+
+    for decoded in decoded_list:
+        if decoded.type == "QRCODE":
+            result += f"{decoded.data}\n"
+
+    return result[:-1]
+
+
+def get_range_table(low: int, high: int) -> List[int]:
+    # Get the lookup table of a grayscale image, the values in the range become 255, the others become 0
+    return [255 if low <= value <= high else 0 for value in range(256)]
@@ -19,13 +19,16 @@
 import logging
 import pickle
 from codecs import getdecoder
+from collections import OrderedDict, deque
+from itertools import count
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from configparser import RawConfigParser
 from os import mkdir
 from os.path import exists
 from shutil import rmtree
 from string import ascii_lowercase
-from threading import Lock
-from typing import Dict, List, Set, Union
+from threading import BoundedSemaphore, Condition, Lock, Thread, local
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple, Union
 
 from emoji import UNICODE_EMOJI_ENGLISH
 from pyrogram.types import Chat, ChatMember
@@ -75,15 +78,25 @@ aio: Union[bool, str] = ""
 backup: Union[bool, str] = ""
 date_reset: str = ""
 default_group_link: str = ""
+image_queue: int = 16
 image_size: int = 0
+image_workers: int = 2
 invalid: Union[str, Set[str]] = ""
+limit_content: int = 10000
+limit_hits: int = 1000
+limit_image: int = 10000
+limit_journal: int = 10000
+limit_text: int = 10000
 limit_track: int = 0
 project_link: str = ""
 project_name: str = ""
 time_captcha: int = 0
+time_content: int = 604800
 time_long: int = 0
 time_new: int = 0
+time_ocr: int = 60
 time_punish: int = 0
+time_save: int = 5
 time_short: int = 0
 time_track: int = 0
 zh_cn: Union[bool, str] = ""
@@ -139,17 +152,27 @@ try:
     backup = eval(backup)
     date_reset = config["custom"].get("date_reset", date_reset)
     default_group_link = config["custom"].get("default_group_link", default_group_link)
+    image_queue = int(config["custom"].get("image_queue", str(image_queue)))
     image_size = int(config["custom"].get("image_size", str(image_size)))
+    image_workers = int(config["custom"].get("image_workers", str(image_workers)))
     invalid = config["custom"].get("invalid", invalid)
     invalid = set(invalid.split())
     invalid = {i.lower() for i in invalid}
+    limit_content = int(config["custom"].get("limit_content", str(limit_content)))
+    limit_hits = int(config["custom"].get("limit_hits", str(limit_hits)))
+    limit_image = int(config["custom"].get("limit_image", str(limit_image)))
+    limit_journal = int(config["custom"].get("limit_journal", str(limit_journal)))
+    limit_text = int(config["custom"].get("limit_text", str(limit_text)))
     limit_track = int(config["custom"].get("limit_track", str(limit_track)))
     project_link = config["custom"].get("project_link", project_link)
     project_name = config["custom"].get("project_name", project_name)
     time_captcha = int(config["custom"].get("time_captcha", str(time_captcha)))
+    time_content = int(config["custom"].get("time_content", str(time_content)))
     time_long = int(config["custom"].get("time_long", str(time_long)))
     time_new = int(config["custom"].get("time_new", str(time_new)))
+    time_ocr = int(config["custom"].get("time_ocr", str(time_ocr)))
     time_punish = int(config["custom"].get("time_punish", str(time_punish)))
+    time_save = int(config["custom"].get("time_save", str(time_save)))
     time_short = int(config["custom"].get("time_short", str(time_short)))
     time_track = int(config["custom"].get("time_track", str(time_track)))
     zh_cn = config["custom"].get("zh_cn", zh_cn)
@@ -197,15 +220,25 @@ if (bot_token in {"", "[DATA EXPUNGED]"}
         or backup not in {False, True}
         or date_reset in {"", "[DATA EXPUNGED]"}
         or default_group_link in {"", "[DATA EXPUNGED]"}
+        or image_queue == 0
         or image_size == 0
+        or image_workers == 0
         or invalid in {"", "[DATA EXPUNGED]"} or invalid == set()
+        or limit_content == 0
+        or limit_hits == 0
+        or limit_image == 0
+        or limit_journal == 0
+        or limit_text == 0
         or limit_track == 0
         or project_link in {"", "[DATA EXPUNGED]"}
         or project_name in {"", "[DATA EXPUNGED]"}
         or time_captcha == 0
+        or time_content == 0
         or time_long == 0
         or time_new == 0
+        or time_ocr == 0
         or time_punish == 0
+        or time_save == 0
         or time_short == 0
         or time_track == 0
         or zh_cn not in {False, True}
@@ -231,16 +264,20 @@ lang: Dict[str, str] = {
     "clear": (zh_cn and "清空数据") or "Clear Data",
     "colon": (zh_cn and "：") or ": ",
     "comma": (zh_cn and "，") or ", ",
+    "content_cache": (zh_cn and "检测结果缓存") or "Verdict Cache",
     "description": (zh_cn and "说明") or "Description",
     "disabled": (zh_cn and "禁用") or "Disabled",
     "enabled": (zh_cn and "启用") or "Enabled",
     "name": (zh_cn and "名称") or "Name",
+    "rate_limit": (zh_cn and "请求限速队列") or "Rate Limit Queue",
     "reason": (zh_cn and "原因") or "Reason",
     "reset": (zh_cn and "重置数据") or "Reset Data",
     "result": (zh_cn and "结果") or "Result",
     "rollback": (zh_cn and "数据回滚") or "Rollback",
+    "save_delay": (zh_cn and "数据保存延迟") or "Save Delay",
     "score": (zh_cn and "评分") or "Score",
     "status_failed": (zh_cn and "未执行") or "Failed",
+    "thread_pool": (zh_cn and "线程池队列") or "Thread Pool Queue",
     "version": (zh_cn and "版本") or "Version",
     # Command
     "command_lack": (zh_cn and "命令参数缺失") or "Lack of Parameter",
@@ -403,19 +440,70 @@ all_commands: List[str] = ["config", "config_nospam", "content", "nospam", "vers
 bot_ids: Set[int] = {avatar_id, captcha_id, clean_id, lang_id, long_id, noflood_id,
                      noporn_id, nospam_id, recheck_id, tip_id, user_id, warn_id}
 
-chats: Dict[int, Chat] = {}
+buckets: Dict[Tuple[str, int], Dict[str, float]] = {}
+# buckets = {
+#     ("send", 0): {
+#         "tokens": 20.0,
+#         "rate": 20.0,
+#         "time": 1512345678.0,
+#         "until": 0.0
+#     }
+# }
+
+# Caches of the requests, a value older than "ttl" is returned while it is refreshed until it is older than "stale"
+# A failed lookup is cached for "negative" seconds
+caches: Dict[str, Dict[str, int]] = {
+    "chats": {"limit": 1000, "ttl": 3600, "stale": 86400, "negative": 60},
+    "members": {"limit": 10000, "ttl": 3600, "stale": 86400, "negative": 300},
+    "sticker_titles": {"limit": 10000, "ttl": 86400, "stale": 604800, "negative": 3600},
+    "usernames": {"limit": 10000, "ttl": 86400, "stale": 604800, "negative": 3600}
+}
+
+chats: Dict[int, Dict[str, Union[bool, float, Chat]]] = OrderedDict()
 # chats = {
-#     -10012345678: Chat
+#     -10012345678: {
+#         "value": Chat,
+#         "time": 1512345678.0,
+#         "ttl": 3600,
+#         "refreshing": False
+#     }
 # }
 
-contents: Dict[str, str] = {}
-# contents = {
-#     "content": "ban"
+compiled: Dict[str, Dict[str, Any]] = {}
+# compiled = {
+#     "ad": {
+#         "words": ["regex"],
+#         "patterns": [Pattern],
+#         "all": {
+#             "combined": Pattern,
+#             "indexes": [0],
+#             "alone": []
+#         },
+#         "ocr": {
+#             "combined": Pattern,
+#             "indexes": [0],
+#             "alone": []
+#         }
+#     }
 # }
 
-declared_message_ids: Dict[int, Set[int]] = {}
+contact_matcher: Dict[str, Any] = {}
+# contact_matcher = {
+#     "contacts": {"@username"},
+#     "size": 1,
+#     "goto": [{"@": 1}, {"u": 2}],
+#     "fail": [0, 0],
+#     "out": [[], []]
+# }
+
+content_stats: Dict[str, int] = {
+    "hit": 0,
+    "miss": 0
+}
+
+declared_message_ids: Dict[int, List[List[Union[int, Set[int]]]]] = {}
 # declared_message_ids = {
-#     -10012345678: {123}
+#     -10012345678: [[428064, {123}], [0, set()]]
 # }
 
 default_config: Dict[str, Union[bool, int]] = {
@@ -454,24 +542,125 @@ default_user_status: Dict[str, Dict[Union[int, str], Union[float, int]]] = {
     }
 }
 
+delay_ids: count = count()
+
+delay_thread: Optional[Thread] = None
+
+delays: List[Tuple[float, int, Callable, tuple, Optional[dict], str]] = []
+# delays = [
+#     (1512345678.0, 0, delete_messages, (Client, -10012345678, [123]), None, "io")
+# ], a min-heap of (time, id, target, args, kwargs, pool), run by the only timer thread
+
+deletions: Dict[int, Set[int]] = {}
+# deletions = {
+#     -10012345678: {123}
+# }
+
 emoji_set: Set[str] = set(UNICODE_EMOJI_ENGLISH)
 
-locks: Dict[str, Lock] = {
+emoji_tokenizer: Dict[str, Any] = {}
+# emoji_tokenizer = {
+#     "pattern": Pattern,
+#     "trie": {
+#         "\U0001F600": {
+#             "": {}
+#         }
+#     }
+# }
+
+executors: Dict[str, ThreadPoolExecutor] = {}
+# executors = {
+#     "io": ThreadPoolExecutor
+# }
+
+expiry: Dict[str, List[Tuple[int, int, int]]] = {
+    "ban": [],
+    "delete": [],
+    "join": []
+}
+# expiry = {
+#     "ban": [(1512345678, 12345678, 0)],
+#     "join": [(1512345678, 12345678, -10012345678)]
+# }, min-heaps of (time, uid, gid), join times expire after time_new, watch times expire at themselves
+
+hits: Dict[Tuple[str, bool], Dict[str, Tuple[str, Any]]] = {}
+# hits = {
+#     ("text", False): {
+#         "ad": ("regex", Match),
+#         "ban": ("", None)
+#     }
+# }
+
+image_jobs: Set[Future] = set()
+
+image_pool: Optional[ProcessPoolExecutor] = None
+
+image_slots: BoundedSemaphore = BoundedSemaphore(image_queue)
+
+journal_sizes: Dict[str, int] = {}
+# journal_sizes = {
+#     "user_ids": 0
+# }
+
+journals: Dict[str, Dict[Any, float]] = {}
+# journals = {
+#     "user_ids": {
+#         12345678: 1512345678.0
+#     }
+# }
+
+# Token buckets of the outbound requests, "all" is shared by all kinds, "chat" by the sends to the same chat
+# A kind may only take a token of "all" when its reserve is left, so lower priority requests yield first
+limits: Dict[str, Dict[str, float]] = {
+    "all": {"rate": 30.0, "burst": 30.0, "reserve": 0.0, "waiting": 0, "floods": 0},
+    "ban": {"rate": 30.0, "burst": 30.0, "reserve": 0.0, "waiting": 0, "floods": 0},
+    "chat": {"rate": 1.0, "burst": 20.0, "reserve": 0.0, "waiting": 0, "floods": 0},
+    "delete": {"rate": 30.0, "burst": 30.0, "reserve": 0.0, "waiting": 0, "floods": 0},
+    "get": {"rate": 30.0, "burst": 30.0, "reserve": 5.0, "waiting": 0, "floods": 0},
+    "log": {"rate": 10.0, "burst": 10.0, "reserve": 15.0, "waiting": 0, "floods": 0},
+    "send": {"rate": 20.0, "burst": 20.0, "reserve": 5.0, "waiting": 0, "floods": 0}
+}
+
+locks: Dict[str, Union[Condition, Lock]] = {
     "admin": Lock(),
-    "message": Lock(),
+    "cache": Lock(),
+    "content": Lock(),
+    "count": Lock(),
+    "delay": Condition(),
+    "delete": Lock(),
+    "expiry": Lock(),
+    "file": Lock(),
+    "hits": Lock(),
+    "image": Lock(),
+    "limit": Lock(),
+    "pool": Lock(),
     "receive": Lock(),
+    "recheck": Lock(),
     "regex": Lock(),
+    "save": Lock(),
+    "t2t": Lock(),
     "test": Lock(),
-    "text": Lock()
+    "trust": Lock(),
+    "window": Lock()
 }
 
-members: Dict[int, Dict[int, ChatMember]] = {}
+members: Dict[Tuple[int, int], Dict[str, Union[bool, float, ChatMember]]] = OrderedDict()
 # members = {
-#     -10012345678: {
-#         12345678: ChatMember
+#     (-10012345678, 12345678): {
+#         "value": ChatMember,
+#         "time": 1512345678.0,
+#         "ttl": 3600,
+#         "refreshing": False
 #     }
 # }
 
+pools: Dict[str, Dict[str, int]] = {
+    "exchange": {"workers": 4, "queue": 1000, "requeue": 0, "pending": 0, "peak": 0, "overflow": 0},
+    "file": {"workers": 2, "queue": 1000, "requeue": 0, "pending": 0, "peak": 0, "overflow": 0},
+    "io": {"workers": 16, "queue": 5000, "requeue": 1, "pending": 0, "peak": 0, "overflow": 0},
+    "log": {"workers": 2, "queue": 1000, "requeue": 0, "pending": 0, "peak": 0, "overflow": 0}
+}
+
 receivers: Dict[str, List[str]] = {
     "bad": ["ANALYZE", "APPLY", "AVATAR", "CAPTCHA", "CLEAN", "LANG", "LONG", "MANAGE",
             "NOFLOOD", "NOPORN", "NOSPAM", "RECHECK", "TICKET", "TIP", "USER", "WATCH"],
@@ -483,9 +672,26 @@ receivers: Dict[str, List[str]] = {
               "NOFLOOD", "NOPORN", "NOSPAM", "RECHECK", "TIP", "USER", "WARN", "WATCH"]
 }
 
-recorded_ids: Dict[int, Set[int]] = {}
+recheck: Dict[str, Union[int, Deque[int]]] = {
+    "interval": 30,
+    "queue": deque(),
+    "batch": 0,
+    "done": 0,
+    "lag": 0,
+    "total": 0
+}
+# recheck = {
+#     "interval": 30,
+#     "queue": deque([12345678]),
+#     "batch": 1,
+#     "done": 0,
+#     "lag": 0,
+#     "total": 1
+# }, a batch of the queue is rechecked every interval seconds, lag is the number of users left by the last round
+
+recorded_ids: Dict[int, List[List[Union[int, Set[int]]]]] = {}
 # recorded_ids = {
-#     -10012345678: {12345678}
+#     -10012345678: [[25683840, {12345678}], [0, set()]]
 # }
 
 regex: Dict[str, bool] = {
@@ -515,25 +721,73 @@ regex: Dict[str, bool] = {
 for c in ascii_lowercase:
     regex[f"ad{c}"] = True
 
+save_delays: Deque[float] = deque(maxlen=1000)
+# save_delays = deque([0.1], maxlen=1000)
+
+saves: Dict[str, float] = {}
+# saves = {
+#     "user_ids": 1512345678.0
+# }
+
 sender: str = "NOSPAM"
 
 should_hide: bool = False
 
-sticker_titles: Dict[str, str] = {}
+sticker_titles: Dict[str, Dict[str, Union[bool, float, str]]] = OrderedDict()
 # sticker_titles = {
-#     "short_name": "sticker_title"
+#     "short_name": {
+#         "value": "sticker_title",
+#         "time": 1512345678.0,
+#         "ttl": 86400,
+#         "refreshing": False
+#     }
 # }
 
-usernames: Dict[str, Dict[str, Union[int, str]]] = {}
+t2t_table: Optional[Dict[int, str]] = None
+# t2t_table = {
+#     65345: "a"
+# }
+
+t2t_texts: Dict[Tuple[str, bool, bool, bool], str] = OrderedDict()
+# t2t_texts = {
+#     ("text", True, True, False): "text"
+# }
+
+tasks: local = local()
+# tasks.pool = "io"
+# tasks.requested = False
+
+trust_groups: Dict[int, Set[int]] = {}
+# trust_groups = {
+#     12345678: {-10012345678}
+# }
+
+user_locks: List[Lock] = [Lock() for _ in range(64)]
+# user_locks = [Lock()], the messages of a user are checked with user_locks[uid % len(user_locks)]
+
+usernames: Dict[str, Dict[str, Union[bool, float, Dict[str, Union[int, str]]]]] = OrderedDict()
 # usernames = {
 #     "SCP_079": {
-#         "peer_type": "channel",
-#         "peer_id": -1001196128009
+#         "value": {
+#             "peer_type": "channel",
+#             "peer_id": -1001196128009
+#         },
+#         "time": 1512345678.0,
+#         "ttl": 86400,
+#         "refreshing": False
 #     }
 # }
 
 version: str = "0.2.3.patch"
 
+windows: Dict[str, Dict[str, int]] = {
+    "declared_message_ids": {"span": 3600, "size": 24},
+    "recorded_ids": {"span": 60, "size": 10}
+}
+# windows = {
+#     "recorded_ids": {"span": 60, "size": 10}
+# }, IDs are kept in size buckets of span seconds, so they expire after (size - 1) * span to size * span seconds
+
 # Load data from pickle
 
 # Init dir
@@ -652,6 +906,35 @@ configs: Dict[int, Dict[str, Union[bool, int]]] = {}
 #     }
 # }
 
+contents: Dict[str, Dict[str, Union[int, str]]] = OrderedDict()
+# contents = {
+#     "content": {
+#         "detection": "ban",
+#         "time": 1512345678
+#     }
+# }
+
+counts: Dict[str, Dict[str, int]] = {}
+# counts = {
+#     "ad": {
+#         "regex": 0
+#     }
+# }
+
+counts_changed: bool = False
+
+images: Dict[str, Dict[str, Union[bool, str]]] = OrderedDict()
+# images = {
+#     "file_unique_id": {
+#         "hash": "md5"
+#     },
+#     "md5": {
+#         "color": False,
+#         "ocr": "text",
+#         "qrcode": ""
+#     }
+# }
+
 # Init word variables
 
 for word_type in regex:
@@ -667,7 +950,10 @@ file_list: List[str] = ["admin_ids", "bad_ids", "except_ids", "lack_group_ids",
                         "configs"]
 file_list += [f"{f}_words" for f in regex]
 
-for file in file_list:
+# Caches and counters are kept across restarts, but they are not backed up or rolled back
+cache_list: List[str] = ["contents", "counts", "images"]
+
+for file in file_list + cache_list:
     try:
         try:
             if exists(f"data/{file}") or exists(f"data/.{file}"):
@@ -685,6 +971,49 @@ for file in file_list:
         logger.critical(f"Load data {file} backup error: {e}", exc_info=True)
         raise SystemExit("[DATA CORRUPTION]")
 
+# Replay the journals written after the snapshots
+journal_list: List[str] = ["user_ids"]
+
+for file in journal_list:
+    try:
+        if not exists(f"data/{file}.journal"):
+            continue
+
+        with open(f"data/{file}.journal", "rb") as f:
+            position = 0
+
+            while True:
+                try:
+                    key, value = pickle.load(f)
+                except EOFError:
+                    break
+                except Exception as e:
+                    logger.warning(f"Replay journal {file} stopped at {position}: {e}")
+                    break
+
+                if value is None:
+                    locals()[f"{file}"].pop(key, None)
+                else:
+                    locals()[f"{file}"][key] = value
+
+                position = f.tell()
+                journal_sizes[file] = journal_sizes.get(file, 0) + 1
+
+        # Drop the broken tail, so the records appended later can be read
+        with open(f"data/{file}.journal", "r+b") as f:
+            f.truncate(position)
+    except Exception as e:
+        logger.critical(f"Replay journal {file} error: {e}", exc_info=True)
+        raise SystemExit("[DATA CORRUPTION]")
+
+# Move the regex hit counts saved in old rule files to the counts
+for word_type in regex:
+    if word_type in counts:
+        continue
+
+    counts[word_type] = {w: c for w, c in locals()[f"{word_type}_words"].items() if c}
+    counts_changed = True
+
 # Generate special characters dictionary
 for special in ["spc", "spe"]:
     locals()[f"{special}_dict"]: Dict[str, str] = {}
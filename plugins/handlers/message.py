@@ -22,15 +22,16 @@ from pyrogram import Client, filters
 from pyrogram.types import Message
 
 from .. import glovar
-from ..functions.channel import get_content, get_debug_text
-from ..functions.etc import code, general_link, get_full_name, get_now, lang, mention_id, t2t, thread
+from ..functions.channel import get_content, get_debug_text, set_content_cache
+from ..functions.etc import code, general_link, get_full_name, get_now, get_user_lock, lang, mention_id, t2t, thread
 from ..functions.file import save
 from ..functions.filters import aio, authorized_group, class_c, class_e, class_d, declared_message, exchange_channel
 from ..functions.filters import from_user, hide_channel, is_bad_message, is_bio_text, is_contact, is_declared_message
-from ..functions.filters import is_nm_text, is_regex_text, new_group, test_group
-from ..functions.filters import is_class_d, is_sender_chat
+from ..functions.filters import is_nm_text, is_regex_hit, new_group, test_group
+from ..functions.filters import is_class_d, is_sender_chat, is_suspicious_user
 from ..functions.group import delete_message, leave_group
-from ..functions.ids import init_group_id, init_user_id
+from ..functions.ids import add_expiry, init_group_id, init_user_id, update_trust_ids
+from ..functions.image import prepare_image
 from ..functions.receive import receive_add_bad, receive_add_except, receive_avatar, receive_captcha_kicked_user
 from ..functions.receive import receive_captcha_kicked_users, receive_clear_data, receive_config_commit
 from ..functions.receive import receive_config_reply, receive_config_show, receive_declared_message
@@ -55,12 +56,12 @@ logger = logging.getLogger(__name__)
 def check(client: Client, message: Message) -> bool:
     # Check the messages sent from groups
 
-    has_text = bool(message and (message.text or message.caption))
+    # Analyse the image without holding the lock
+    prepare_image(client, message, is_suspicious_user(message.chat.id, message.from_user, message.date or get_now()))
 
-    if has_text:
-        glovar.locks["text"].acquire()
-    else:
-        glovar.locks["message"].acquire()
+    # Messages of different users are checked in parallel
+    lock = get_user_lock(message.from_user.id)
+    lock.acquire()
 
     try:
         # Basic data
@@ -85,7 +86,7 @@ def check(client: Client, message: Message) -> bool:
             result = terminate_user(client, message, message.from_user, detection)
 
             if result and content and detection != "true":
-                glovar.contents[content] = detection
+                set_content_cache(content, detection)
         elif glovar.configs[gid].get("message") and glovar.configs[gid].get("sticker") and message.sticker:
             if content:
                 glovar.except_ids["temp"].add(content)
@@ -95,10 +96,7 @@ def check(client: Client, message: Message) -> bool:
     except Exception as e:
         logger.warning(f"Check error: {e}", exc_info=True)
     finally:
-        if has_text:
-            glovar.locks["text"].release()
-        else:
-            glovar.locks["message"].release()
+        lock.release()
 
     return False
 
@@ -129,7 +127,6 @@ def check_sender_chat(client: Client, message: Message) -> bool:
                    & ~declared_message)
 def check_join(client: Client, message: Message) -> bool:
     # Check new joined user
-    glovar.locks["message"].acquire()
     try:
         # Basic data
         gid = message.chat.id
@@ -139,81 +136,82 @@ def check_join(client: Client, message: Message) -> bool:
             # Basic data
             uid = new.id
 
-            # TODO TEMP: Check class D
-            if is_class_d(None, None, message):
-                mid = message.message_id
-                uid = message.from_user and message.from_user.id
-                logger.warning(f"TEMP delete Class D message {mid} in {gid} from {uid}")
-                return delete_message(client, gid, mid)
-
-            # Check if the user is Class D personnel
-            if uid in glovar.bad_ids["users"]:
-                continue
-
-            # Check if the user is white user
-            if uid in glovar.white_ids:
-                continue
-
-            # Check declare status
-            if is_declared_message(None, None, message):
-                return True
-
-            # Init the user's status
-            if not init_user_id(uid):
-                continue
-
-            # Check name
-            if glovar.configs[gid].get("nick"):
-                name = get_full_name(new)
-
-                if name and name not in glovar.except_ids["long"]:
-                    t2t_name = t2t(name, True, True, True)
-
-                    if is_nm_text(t2t_name):
-                        terminate_user(client, message, new, "ban nick")
-                    elif name in glovar.bad_ids["contents"]:
-                        terminate_user(client, message, new, "ban nick record")
-                    elif is_contact(t2t_name):
-                        terminate_user(client, message, new, "ban nick contact")
-                    elif is_regex_text("wb", t2t_name) and is_regex_text("sho", t2t_name):
-                        terminate_user(client, message, new, "ban nick")
-                    elif is_regex_text("bad", t2t_name) or is_regex_text("sho", t2t_name):
-                        terminate_user(client, message, new, "bad nick")
-
-            # Check username
-            username = new.username
-
-            if username and is_nm_text(username):
-                terminate_user(client, message, new, "ban username")
-
-            # Check bio
-            if glovar.configs[gid].get("bio"):
-                user = get_user_full(client, uid)
-
-                if not user or not user.about:
-                    bio = ""
-                else:
-                    bio = t2t(user.about, True, True, True)
-
-                if bio and bio not in glovar.except_ids["long"]:
-                    if is_bio_text(bio):
-                        terminate_user(client, message, new, f"ban bio {bio}")
-                    elif user.about in glovar.bad_ids["contents"]:
-                        terminate_user(client, message, new, f"ban bio {bio}")
-
-            # Check bot
-            if glovar.configs[gid].get("bot") and new.is_bot:
-                terminate_user(client, message, new, "ban bot")
-
-            # Update user's join status
-            glovar.user_ids[uid]["join"][gid] = now
-            save("user_ids")
+            # The new member's data is changed under the member's own lock
+            with get_user_lock(uid):
+                # TODO TEMP: Check class D
+                if is_class_d(None, None, message):
+                    mid = message.message_id
+                    uid = message.from_user and message.from_user.id
+                    logger.warning(f"TEMP delete Class D message {mid} in {gid} from {uid}")
+                    return delete_message(client, gid, mid)
+
+                # Check if the user is Class D personnel
+                if uid in glovar.bad_ids["users"]:
+                    continue
+
+                # Check if the user is white user
+                if uid in glovar.white_ids:
+                    continue
+
+                # Check declare status
+                if is_declared_message(None, None, message):
+                    return True
+
+                # Init the user's status
+                if not init_user_id(uid):
+                    continue
+
+                # Check name
+                if glovar.configs[gid].get("nick"):
+                    name = get_full_name(new)
+
+                    if name and name not in glovar.except_ids["long"]:
+                        t2t_name = t2t(name, True, True, True)
+
+                        if is_nm_text(t2t_name):
+                            terminate_user(client, message, new, "ban nick")
+                        elif name in glovar.bad_ids["contents"]:
+                            terminate_user(client, message, new, "ban nick record")
+                        elif is_contact(t2t_name):
+                            terminate_user(client, message, new, "ban nick contact")
+                        elif is_regex_hit("wb", t2t_name) and is_regex_hit("sho", t2t_name):
+                            terminate_user(client, message, new, "ban nick")
+                        elif is_regex_hit("bad", t2t_name) or is_regex_hit("sho", t2t_name):
+                            terminate_user(client, message, new, "bad nick")
+
+                # Check username
+                username = new.username
+
+                if username and is_nm_text(username):
+                    terminate_user(client, message, new, "ban username")
+
+                # Check bio
+                if glovar.configs[gid].get("bio"):
+                    user = get_user_full(client, uid)
+
+                    if not user or not user.about:
+                        bio = ""
+                    else:
+                        bio = t2t(user.about, True, True, True)
+
+                    if bio and bio not in glovar.except_ids["long"]:
+                        if is_bio_text(bio):
+                            terminate_user(client, message, new, f"ban bio {bio}")
+                        elif user.about in glovar.bad_ids["contents"]:
+                            terminate_user(client, message, new, f"ban bio {bio}")
+
+                # Check bot
+                if glovar.configs[gid].get("bot") and new.is_bot:
+                    terminate_user(client, message, new, "ban bot")
+
+                # Update user's join status
+                glovar.user_ids[uid]["join"][gid] = now
+                add_expiry("join", now, uid, gid)
+                save("user_ids", uid)
 
         return True
     except Exception as e:
         logger.warning(f"Check join error: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
 
     return False
 
@@ -254,7 +252,7 @@ def exchange_emergency(client: Client, message: Message) -> bool:
         text = (f"{lang('project')}{lang('colon')}{project_text}\n"
                 f"{lang('action')}{lang('colon')}{code(lang('transfer_channel'))}\n"
                 f"{lang('emergency_channel')}{lang('colon')}{code(hide_text)}\n")
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="log")
 
         return True
     except Exception as e:
@@ -301,10 +299,9 @@ def init_group(client: Client, message: Message) -> bool:
                 save("admin_ids")
 
                 # Trust list
-                glovar.trust_ids[gid] = {admin.user.id for admin in admin_members
-                                         if ((not admin.user.is_bot and not admin.user.is_deleted)
-                                             or admin.user.id in glovar.bot_ids)}
-                save("trust_ids")
+                update_trust_ids(gid, {admin.user.id for admin in admin_members
+                                       if ((not admin.user.is_bot and not admin.user.is_deleted)
+                                           or admin.user.id in glovar.bot_ids)})
 
                 # Text
                 text += f"{lang('status')}{lang('colon')}{code(lang('status_joined'))}\n"
@@ -328,7 +325,7 @@ def init_group(client: Client, message: Message) -> bool:
             text += f"{lang('inviter')}{lang('colon')}{code(inviter.id)}\n"
 
         # Send debug message
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="log")
 
         return True
     except Exception as e:
@@ -445,7 +442,7 @@ def process_data(client: Client, message: Message) -> bool:
 
                 elif action == "backup":
                     if action_type == "now":
-                        thread(backup_files, (client,))
+                        thread(backup_files, (client,), pool="file")
                     elif action_type == "rollback":
                         receive_rollback(client, message, data)
 